@@ -0,0 +1,24 @@
+# Gunicorn 配置：docker 镜像默认使用，手动启动时 gunicorn -c gunicorn.conf.py server:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5010')}"
+
+# 只用1个进程：视频并发闸门、内存统计、支付去重缓存、ComfyUI事件推送都在进程内，
+# 多进程会让并发上限翻倍、统计各算各的
+workers = 1
+
+# SSE长连接每个占一个线程（视频最长10分钟），线程数决定同时在线的流数量
+worker_class = "gthread"
+threads = int(os.getenv('GUNICORN_THREADS', '64'))
+
+# 必须大于视频超时（VIDEO_TIMEOUT=600秒），否则生成中的流会被当成卡死的worker杀掉
+timeout = 650
+graceful_timeout = 30
+keepalive = 5
+
+# 不能 preload：日志写入、Telegram发送、事件推送等后台线程在导入时启动，fork之后不会带到worker里
+preload_app = False
+
+accesslog = None
+errorlog = "-"
+loglevel = "warning"
@@ -8,26 +8,54 @@
 """
 
 import os
-import json
+import re
 import time
-import base64
 import uuid
 import random
 import requests
+import orjson
 import threading
 import hmac
 import hashlib
-import hmac
 import sys
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
+import ssl
+import queue
+import atexit
+import copy
+import heapq
+import mimetypes
+import mmap
+import gc
+import ctypes
+from datetime import datetime, timezone, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, Request, request, jsonify, send_from_directory, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from werkzeug.security import safe_join
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from urllib.parse import quote
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 禁用 SSL 证书验证警告（视频端点证书已过期）
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# base64解码（可选依赖：安装了pybase64时使用SIMD加速版本，接口和异常与标准库一致）
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+# ComfyUI WebSocket 事件推送（可选依赖，缺失时回退到HTTP轮询）
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
 # 加载环境变量
 load_dotenv()
 
@@ -45,7 +73,32 @@ except Exception as e:
     bot_db = None
     print(f"⚠️  Bot database initialization failed: {e}")
 
+class OrjsonProvider(JSONProvider):
+    """jsonify 和 request.json 使用 orjson 序列化/解析"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class LimitedRequest(Request):
+    """按接口限制请求体大小
+
+    Werkzeug 读取请求体（request.json / request.form）时按 max_content_length 检查，
+    超过即抛出 RequestEntityTooLarge，不会把整个请求体读进内存；没有 Content-Length 的分块请求也一样。
+    MAX_CONTENT_LENGTH 是全局配置，会误伤带base64图片的接口，所以只对支付回调生效。
+    """
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'webhook_plisio':
+            return WEBHOOK_MAX_BODY
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = LimitedRequest
+app.json = OrjsonProvider(app)
 CORS(app, resources={
     r"/*": {
         "origins": "*",
@@ -66,11 +119,10 @@ def after_request(response):
     return response
 
 # ===== 配置 =====
-# Load environment variables from .env file
-from dotenv import load_dotenv
-load_dotenv()  # 加载 .env 文件中的环境变量
+# 环境变量已在文件开头通过 load_dotenv() 加载
 
 SERVER_AUTH_KEY = os.getenv('SERVER_AUTH_KEY', 'default-insecure-key')  # 从环境变量读取
+SERVER_AUTH_KEY_BYTES = SERVER_AUTH_KEY.encode()  # 预先编码，每次校验不再重复encode
 
 # Plisio配置
 PLISIO_SECRET_KEY = os.getenv('PLISIO_SECRET_KEY', '')
@@ -80,7 +132,7 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 
 # Admin IDs for notifications
 ADMIN_IDS_STR = os.getenv('ADMIN_IDS', '')
-ADMIN_IDS = [int(id.strip()) for id in ADMIN_IDS_STR.split(',') if id.strip()] if ADMIN_IDS_STR else []
+ADMIN_IDS = frozenset(int(id) for id in ADMIN_IDS_STR.split(',') if id.strip())
 
 # ComfyUI 直接API配置（图像生成）
 COMFYUI_API_URL = os.getenv('COMFYUI_API_URL', "http://dx.qyxc.vip:18188")  # ComfyUI服务器地址
@@ -90,6 +142,12 @@ COMFYUI_CLIENT_ID = str(uuid.uuid4())
 COMFYUI_VIDEO_API_URL = os.getenv('COMFYUI_VIDEO_API_URL', "https://n008.unicorn.org.cn:20155")  # 视频生成专用ComfyUI端点
 COMFYUI_VIDEO_CLIENT_ID = str(uuid.uuid4())
 
+# 生成文件的浏览器缓存时间（文件名唯一，内容不会变化）
+FILES_MAX_AGE = 86400
+# 部署在nginx后面时，由nginx通过 X-Accel-Redirect 直接发送文件（见 DEPLOY.md）
+USE_XACCEL = os.getenv('USE_XACCEL', '0') == '1'
+XACCEL_IMAGES_PREFIX = '/_internal_images/'
+
 # 目录配置
 FILES_DIR = os.path.join(os.getcwd(), "files")
 IMAGES_DIR = os.path.join(FILES_DIR, "images")
@@ -99,30 +157,134 @@ os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
 # 并发控制 - 每种类型各5个并发
+class BoundedConcurrency:
+    """并发闸门：最多 max_concurrent 个任务同时执行，已满时立即拒绝
+
+    不在请求线程里排队等待：SSE 响应开始前阻塞会让客户端长时间收不到任何数据，
+    被拒绝的请求按 Retry-After 稍后重试即可。
+    """
+
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """获取执行名额，并发已满返回False"""
+        with self._lock:
+            if self.active >= self.max_concurrent:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def resize(self, max_concurrent):
+        """调整并发上限；调小时已在执行的任务不受影响，只是暂不放行新任务"""
+        with self._lock:
+            self.max_concurrent = max_concurrent
+
+    def snapshot(self):
+        """返回执行中数量"""
+        with self._lock:
+            return self.active
+
 MAX_CONCURRENT_T2V = 5  # 文生视频竖屏
 MAX_CONCURRENT_I2V = 5  # 图生视频竖屏
-t2v_semaphore = threading.Semaphore(MAX_CONCURRENT_T2V)
-i2v_semaphore = threading.Semaphore(MAX_CONCURRENT_I2V)
-t2v_count = 0
-i2v_count = 0
-count_lock = threading.Lock()
+VIDEO_RETRY_AFTER = 30  # 拒绝时建议客户端重试的间隔（秒）
+t2v_gate = BoundedConcurrency(MAX_CONCURRENT_T2V)
+i2v_gate = BoundedConcurrency(MAX_CONCURRENT_I2V)
+
+# 根据视频ComfyUI的排队情况自动调整并发上限（1 ~ MAX_CONCURRENT_*），默认关闭
+ADAPTIVE_VIDEO_CONCURRENCY = os.getenv('ADAPTIVE_VIDEO_CONCURRENCY', '0') == '1'
+VIDEO_ADAPT_INTERVAL = 10  # 检查ComfyUI队列的间隔（秒）
+
+# 图像ComfyUI空闲时定期提交一个1步的小任务，让模型常驻显存，避免冷启动重新加载模型，默认关闭
+COMFYUI_KEEP_WARM = os.getenv('COMFYUI_KEEP_WARM', '0') == '1'
+KEEP_WARM_INTERVAL = 60  # 空闲多久（秒）后预热一次
 
 # 视频超时时间：10分钟
 VIDEO_TIMEOUT = 600
 
+# ComfyUI HTTP超时（连接超时, 读取超时）
+# 连接超时单独设短：端点不可达时快速失败，避免工作线程被挂起长达2分钟
+COMFYUI_CONNECT_TIMEOUT = 10
+COMFYUI_SUBMIT_TIMEOUT = (COMFYUI_CONNECT_TIMEOUT, 120)
+COMFYUI_POLL_TIMEOUT = (COMFYUI_CONNECT_TIMEOUT, 30)
+COMFYUI_DOWNLOAD_TIMEOUT = (COMFYUI_CONNECT_TIMEOUT, 120)
+COMFYUI_UPLOAD_TIMEOUT = (COMFYUI_CONNECT_TIMEOUT, 60)
+
+# ComfyUI调试输出（打印history/outputs详细结构），生产环境默认关闭
+DEBUG_COMFY = os.getenv('DEBUG_COMFY', '0') == '1'
+
+# WebSocket事件推送已连接时，仅作为兜底的history查询间隔（秒）
+COMFYUI_WS_FALLBACK_POLL = 30
+
+# 流式响应每轮等待的间隔（秒）：从1秒开始按1.3倍增长到5秒，加±10%抖动，
+# 推送不可用时也就是history的轮询间隔；同时决定心跳频率，上限不能太大
+POLL_DELAY_START = 1.0
+POLL_DELAY_MAX = 5.0
+POLL_BACKOFF = 1.3
+
+# 心跳间隔（秒）：流空闲时最多每5秒发送一次空内容，防止代理断开连接
+SSE_KEEPALIVE_INTERVAL = 5
+
+def next_poll_delay(delay):
+    return min(POLL_DELAY_MAX, delay * POLL_BACKOFF) * random.uniform(0.9, 1.1)
+
+# ComfyUI HTTP会话：复用连接池，避免每次轮询都重新建立TCP/TLS连接
+def create_comfyui_session():
+    session = requests.Session()
+    # 只对GET等幂等请求重试网关错误；POST /prompt 不重试，避免重复提交任务
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+comfyui_session = create_comfyui_session()  # 图像端点
+comfyui_video_session = create_comfyui_session()  # 视频端点
+
+# 端点地址和会话成对更新；调用方在函数入口一次性取快照，避免同一请求中途切换端点
+endpoint_lock = threading.Lock()
+
+def get_comfyui_endpoint():
+    """返回图像端点的 (base_url, session)"""
+    with endpoint_lock:
+        return COMFYUI_API_URL, comfyui_session
+
+def get_comfyui_video_endpoint():
+    """返回视频端点的 (base_url, session)"""
+    with endpoint_lock:
+        return COMFYUI_VIDEO_API_URL, comfyui_video_session
+
 # 文件清理配置：基于存储空间大小
 MAX_STORAGE_SIZE_GB = 10  # 最大存储空间10GB
 CLEANUP_SIZE_GB = 2  # 超过限制时删除2GB内容
-CLEANUP_CHECK_INTERVAL = 600  # 每10分钟检查一次是否到清理时间
 CLEANUP_HOUR = 3  # 上海时间3点执行清理（UTC+8）
+SHANGHAI_TZ = timezone(timedelta(hours=8))
+CLEANUP_WORKERS = 8  # 并行删除文件的线程数
+STORAGE_RESEED_INTERVAL = 3600  # 每小时重新扫描一次目录，校正存储计数的偏差
+
+# 存储用量计数：写入/删除文件时增量更新，查询时无需扫描目录
+storage_lock = threading.Lock()
+storage_bytes = 0
+storage_file_count = 0
+
+# 统计数据（当天计数，启动时从日志文件恢复，跨天自动清零）
+def new_daily_stats(date_str):
+    """创建某一天的空统计"""
+    return {
+        "date": date_str,
+        "image": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
+        "video_t2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
+        "video_i2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
+    }
 
-# 统计数据
 stats_lock = threading.Lock()
-daily_stats = {
-    "image": {"total": 0, "success": 0, "failed": 0},
-    "video_t2v": {"total": 0, "success": 0, "failed": 0},
-    "video_i2v": {"total": 0, "success": 0, "failed": 0},
-}
+daily_stats = new_daily_stats(datetime.now().strftime("%Y-%m-%d"))
 
 # ===== 工作流模板 =====
 # 图像生成工作流（带LoRA）
@@ -216,34 +378,129 @@ def load_video_workflows():
     t2v_path = "video_wan2_2_14B_t2v_API_Cephalon.json"
     i2v_path = "video_wan2_2_14B_i2v_API_Cephalon.json"
     
-    with open(t2v_path, "r", encoding="utf-8") as f:
-        t2v_workflow = json.load(f)
+    with open(t2v_path, "rb") as f:
+        t2v_workflow = orjson.loads(f.read())
     
-    with open(i2v_path, "r", encoding="utf-8") as f:
-        i2v_workflow = json.load(f)
+    with open(i2v_path, "rb") as f:
+        i2v_workflow = orjson.loads(f.read())
     
     return t2v_workflow, i2v_workflow
 
 T2V_WORKFLOW, I2V_WORKFLOW = load_video_workflows()
 
+# 工作流模板预先编码为JSON bytes：固定参数直接写入，每个请求变化的参数用 "__NAME__" 占位符
+# 编码后按占位符切分成片段，请求时只需编码这几个值再拼接，无需复制和重新序列化整个工作流
+WORKFLOW_PLACEHOLDER_RE = re.compile(rb'"__([A-Z]+)__"')
+
+def build_workflow_template(workflow, fixed=(), slots=()):
+    """fixed: [(节点, 参数, 值)] 固定写入；slots: [(节点, 参数, 占位符名)]；节点不存在时跳过"""
+    workflow = orjson.loads(orjson.dumps(workflow))
+    for node_id, input_name, value in fixed:
+        if node_id in workflow:
+            workflow[node_id]["inputs"][input_name] = value
+    for node_id, input_name, name in slots:
+        if node_id in workflow:
+            workflow[node_id]["inputs"][input_name] = f"__{name}__"
+    # 切分结果：[文本, 占位符名, 文本, 占位符名, ..., 文本]
+    return WORKFLOW_PLACEHOLDER_RE.split(orjson.dumps(workflow))
+
+def render_workflow(template, **values):
+    """用本次请求的参数填充模板，返回工作流的JSON bytes"""
+    parts = template[:]
+    for i in range(1, len(parts), 2):
+        parts[i] = orjson.dumps(values[parts[i].decode()])
+    return b"".join(parts)
+
+IMAGE_WORKFLOW_TEMPLATE = build_workflow_template(IMAGE_WORKFLOW, slots=[
+    ("3", "seed", "SEED"),
+    ("6", "text", "PROMPT"),
+    ("13", "width", "WIDTH"),
+    ("13", "height", "HEIGHT"),
+])
+
+# 预热工作流：与正式工作流使用同样的加载节点，1步、256x256，输出用PreviewImage写到ComfyUI临时目录
+WARM_IMAGE_WORKFLOW = orjson.loads(orjson.dumps(IMAGE_WORKFLOW))
+WARM_IMAGE_WORKFLOW["3"]["inputs"]["steps"] = 1
+WARM_IMAGE_WORKFLOW["6"]["inputs"]["text"] = "warm up"
+WARM_IMAGE_WORKFLOW["13"]["inputs"]["width"] = 256
+WARM_IMAGE_WORKFLOW["13"]["inputs"]["height"] = 256
+WARM_IMAGE_WORKFLOW["9"] = {"inputs": {"images": ["8", 0]}, "class_type": "PreviewImage"}
+WARM_IMAGE_WORKFLOW_JSON = orjson.dumps(WARM_IMAGE_WORKFLOW)
+
+# 负面提示词 - 与ComfyUI工作流一致（T2V包含额外的"裸露，NSFW"）
+T2V_NEG_PROMPT = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走，裸露，NSFW"
+
+T2V_WORKFLOW_TEMPLATE = build_workflow_template(T2V_WORKFLOW, fixed=[
+    ("72", "text", T2V_NEG_PROMPT),
+    # 视频尺寸为竖屏
+    ("74", "width", 480),
+    ("74", "height", 832),
+    ("74", "length", 81),
+], slots=[
+    ("89", "text", "PROMPT"),
+    # 随机种子 - 需要同时更新两个KSampler节点
+    ("81", "noise_seed", "SEED"),
+    ("78", "noise_seed", "SEED"),
+])
+
+# 📝 图生视频使用工作流中固定的提示词（节点93和89），不做修改
+I2V_WORKFLOW_TEMPLATE = build_workflow_template(I2V_WORKFLOW, fixed=[
+    ("98", "width", 480),
+    ("98", "height", 832),
+    ("98", "length", 81),
+], slots=[
+    ("86", "noise_seed", "SEED"),
+    ("85", "noise_seed", "SEED"),
+    ("97", "image", "IMAGE"),
+])
+
 # ===== 文件清理函数 =====
 def get_directory_size(directory):
-    """计算目录总大小（字节）"""
+    """扫描目录，返回 (总大小字节, 文件数)"""
     total_size = 0
+    file_count = 0
     try:
-        for filename in os.listdir(directory):
-            filepath = os.path.join(directory, filename)
-            if os.path.isfile(filepath):
-                total_size += os.path.getsize(filepath)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total_size += entry.stat().st_size
+                    file_count += 1
     except Exception as e:
         print(f"计算目录大小时出错: {e}")
-    return total_size
+    return total_size, file_count
+
+def reseed_storage_usage():
+    """重新扫描 IMAGES_DIR，校正存储计数"""
+    global storage_bytes, storage_file_count
+    total_size, file_count = get_directory_size(IMAGES_DIR)
+    with storage_lock:
+        storage_bytes = total_size
+        storage_file_count = file_count
+    return total_size, file_count
+
+def track_storage(size_delta, count_delta=1):
+    """写入文件后传入正数，删除文件后传入负数"""
+    global storage_bytes, storage_file_count
+    with storage_lock:
+        storage_bytes += size_delta
+        storage_file_count += count_delta
+
+def get_storage_usage():
+    """返回计数中的 (总大小字节, 文件数)，O(1)"""
+    with storage_lock:
+        return storage_bytes, storage_file_count
+
+def storage_reseed_loop():
+    """后台定时校正存储计数"""
+    while True:
+        time.sleep(STORAGE_RESEED_INTERVAL)
+        reseed_storage_usage()
 
 def cleanup_old_files():
     """基于存储空间的智能清理：超过10GB时删除最旧的2GB文件"""
     try:
-        # 计算当前目录总大小
-        total_size = get_directory_size(IMAGES_DIR)
+        # 计算当前目录总大小（完整扫描，同时校正计数）
+        total_size, _ = reseed_storage_usage()
         total_size_gb = total_size / (1024 ** 3)
         
         print(f"📊 当前存储使用: {total_size_gb:.2f}GB / {MAX_STORAGE_SIZE_GB}GB")
@@ -255,41 +512,56 @@ def cleanup_old_files():
         
         print(f"⚠️  存储空间已达 {total_size_gb:.2f}GB，开始清理 {CLEANUP_SIZE_GB}GB 的旧文件...")
         
-        # 获取所有文件及其修改时间
+        # 获取所有文件及其修改时间：(path, name, mtime, size)，一次scandir即可拿到stat信息
         files_info = []
-        for filename in os.listdir(IMAGES_DIR):
-            filepath = os.path.join(IMAGES_DIR, filename)
-            if os.path.isfile(filepath):
-                file_mtime = os.path.getmtime(filepath)
-                file_size = os.path.getsize(filepath)
-                files_info.append({
-                    'path': filepath,
-                    'name': filename,
-                    'mtime': file_mtime,
-                    'size': file_size
-                })
-        
-        # 按修改时间排序（最旧的在前）
-        files_info.sort(key=lambda x: x['mtime'])
+        with os.scandir(IMAGES_DIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat()
+                    files_info.append((entry.path, entry.name, st.st_mtime, st.st_size))
+        
+        # 按天排序（最旧的在前），同一天内先删大文件，用更少的删除释放更多空间
+        cleanup_order = lambda f: (f[2] // 86400, -f[3])
         
         # 计算需要删除的大小（2GB）
         cleanup_bytes = CLEANUP_SIZE_GB * (1024 ** 3)
         
-        cleaned_count = 0
-        cleaned_size = 0
-        
-        # 从最旧的文件开始删除，直到删除了2GB
-        for file_info in files_info:
-            if cleaned_size >= cleanup_bytes:
+        # 只需要删除一小部分文件：按比例估算数量（留20%余量），用堆取最旧的k个，避免全量排序
+        k = int(len(files_info) * (CLEANUP_SIZE_GB / MAX_STORAGE_SIZE_GB) * 1.2) + 1
+        candidates = heapq.nsmallest(k, files_info, key=cleanup_order)
+        if sum(f[3] for f in candidates) < cleanup_bytes:
+            # 估算不足（旧文件偏小），退回全量排序
+            candidates = sorted(files_info, key=cleanup_order)
+        
+        # 从最旧的文件开始选取，直到凑够2GB
+        to_delete = []
+        selected_size = 0
+        for file_info in candidates:
+            if selected_size >= cleanup_bytes:
                 break
-            
+            to_delete.append(file_info)
+            selected_size += file_info[3]
+        
+        def remove_file(file_info):
+            file_path, file_name, _, file_size = file_info
             try:
-                os.remove(file_info['path'])
-                cleaned_count += 1
-                cleaned_size += file_info['size']
-                print(f"🗑️  清理文件: {file_info['name']} ({file_info['size'] / 1024 / 1024:.2f}MB)")
+                os.unlink(file_path)
+                track_storage(-file_size, -1)
+                print(f"🗑️  清理文件: {file_name} ({file_size / 1024 / 1024:.2f}MB)")
+                return file_size
+            except FileNotFoundError:
+                # 扫描之后已被删除，跳过
+                return None
             except Exception as e:
-                print(f"删除文件失败 {file_info['name']}: {e}")
+                print(f"删除文件失败 {file_name}: {e}")
+                return None
+        
+        # 多线程并行删除，掩盖逐个unlink的元数据延迟
+        with ThreadPoolExecutor(max_workers=CLEANUP_WORKERS) as executor:
+            removed_sizes = [size for size in executor.map(remove_file, to_delete) if size is not None]
+        
+        cleaned_count = len(removed_sizes)
+        cleaned_size = sum(removed_sizes)
         
         final_size = total_size - cleaned_size
         final_size_gb = final_size / (1024 ** 3)
@@ -301,32 +573,13 @@ def cleanup_old_files():
         import traceback
         traceback.print_exc()
 
-# 记录上次清理日期
-last_cleanup_date = None
-
-def should_run_cleanup():
-    """检查是否应该运行清理（每天上海时间3点）"""
-    global last_cleanup_date
-    
-    from datetime import datetime, timezone, timedelta
-    
-    # 上海时区 UTC+8
-    shanghai_tz = timezone(timedelta(hours=8))
-    now_shanghai = datetime.now(shanghai_tz)
-    
-    current_date = now_shanghai.date()
-    current_hour = now_shanghai.hour
-    
-    # 如果今天已经清理过，则不再清理
-    if last_cleanup_date == current_date:
-        return False
-    
-    # 如果当前时间是3点（3:00-3:59），执行清理
-    if current_hour == CLEANUP_HOUR:
-        last_cleanup_date = current_date
-        return True
-    
-    return False
+def seconds_until_next_cleanup():
+    """距离下一次上海时间 CLEANUP_HOUR:00 的秒数"""
+    now_shanghai = datetime.now(SHANGHAI_TZ)
+    next_run = now_shanghai.replace(hour=CLEANUP_HOUR, minute=0, second=0, microsecond=0)
+    if next_run <= now_shanghai:
+        next_run += timedelta(days=1)
+    return (next_run - now_shanghai).total_seconds()
 
 def auto_cleanup_loop():
     """后台定时清理线程 - 每天上海时间3点执行一次"""
@@ -334,86 +587,180 @@ def auto_cleanup_loop():
     
     while True:
         try:
-            time.sleep(CLEANUP_CHECK_INTERVAL)
+            # 直接睡到下一次清理时间，不再每10分钟醒来检查
+            time.sleep(seconds_until_next_cleanup())
             
-            if should_run_cleanup():
-                from datetime import datetime, timezone, timedelta
-                shanghai_tz = timezone(timedelta(hours=8))
-                now_shanghai = datetime.now(shanghai_tz)
-                print(f"\n⏰ 定时清理触发 - 上海时间: {now_shanghai.strftime('%Y-%m-%d %H:%M:%S')}")
-                cleanup_old_files()
+            now_shanghai = datetime.now(SHANGHAI_TZ)
+            print(f"\n⏰ 定时清理触发 - 上海时间: {now_shanghai.strftime('%Y-%m-%d %H:%M:%S')}")
+            cleanup_old_files()
         except Exception as e:
             print(f"自动清理循环错误: {e}")
             import traceback
             traceback.print_exc()
+        # 避开触发时刻，防止系统时钟校准导致同一天重复清理
+        time.sleep(60)
 
 # 启动清理线程
 cleanup_thread = threading.Thread(target=auto_cleanup_loop, daemon=True)
 cleanup_thread.start()
 
+# 初始化存储计数并启动定时校正线程
+reseed_storage_usage()
+threading.Thread(target=storage_reseed_loop, daemon=True).start()
+
 # ===== 日志函数 =====
+# 日志写入队列：请求线程只负责序列化和入队，由后台线程批量追加到文件
+log_queue = queue.SimpleQueue()  # 只需put/get，不需要Queue的task_done和maxsize
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.1  # 收到第一条后稍等片刻，把同一时间段的日志合并成一次写入
+
+def write_log_batch(batch):
+    """把 (log_file, line) 列表按文件分组后一次性写入"""
+    lines_by_file = {}
+    for log_file, line in batch:
+        lines_by_file.setdefault(log_file, []).append(line)
+    
+    for log_file, lines in lines_by_file.items():
+        try:
+            with open(log_file, "ab") as f:
+                f.writelines(lines)
+        except Exception as e:
+            print(f"日志写入错误: {e}")
+
+def drain_log_queue(first=None):
+    """取出队列中已有的日志（最多 LOG_BATCH_SIZE 条）并写入"""
+    batch = [first] if first is not None else []
+    while len(batch) < LOG_BATCH_SIZE:
+        try:
+            batch.append(log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        write_log_batch(batch)
+
+def log_writer_loop():
+    """后台日志写入线程"""
+    while True:
+        first = log_queue.get()
+        time.sleep(LOG_FLUSH_INTERVAL)
+        drain_log_queue(first)
+
 def log_request(service_type, status, details=None):
-    """简化的统一日志记录"""
+    """简化的统一日志记录
+
+    这不是调试日志：统计接口和历史统计都依赖这些记录，所以不受日志级别控制。
+    """
     try:
-        today = datetime.now().strftime("%Y-%m-%d")
+        now = datetime.now()
+        today = now.strftime("%Y-%m-%d")
         log_file = os.path.join(LOGS_DIR, f"requests_{today}.jsonl")
         
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now.isoformat(),
             "service": service_type,  # image, video_t2v, video_i2v
             "status": status,  # success, failed, rejected
             "details": details or {}
         }
         
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+        log_queue.put((log_file, orjson.dumps(log_entry) + b"\n"))
         
         # 更新内存统计
         with stats_lock:
+            roll_daily_stats(today)
             if service_type in daily_stats:
                 daily_stats[service_type]["total"] += 1
-                if status == "success":
-                    daily_stats[service_type]["success"] += 1
-                elif status == "failed":
-                    daily_stats[service_type]["failed"] += 1
+                if status in ("success", "failed", "rejected"):
+                    daily_stats[service_type][status] += 1
     except Exception as e:
         print(f"日志记录错误: {e}")
 
+threading.Thread(target=log_writer_loop, daemon=True).start()
+# 进程退出前写完队列中剩余的日志
+atexit.register(lambda: drain_log_queue() if not log_queue.empty() else None)
+
+def roll_daily_stats(today):
+    """跨天时清零内存统计（需持有 stats_lock）"""
+    global daily_stats
+    if daily_stats["date"] != today:
+        daily_stats = new_daily_stats(today)
+
+def count_log_file(log_path, stats):
+    """把一个JSONL日志文件中的请求计入 stats
+
+    用mmap映射整个文件后按换行切分，不经过Python的逐行读取缓冲。
+    """
+    with open(log_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return stats  # 空文件无法mmap
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end < 0:
+                    end = size
+                line = mm[start:end]
+                start = end + 1
+                if not line.strip():
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                service = entry.get("service")
+                if service in stats:
+                    stats[service]["total"] += 1
+                    status = entry.get("status")
+                    if status in ("success", "failed", "rejected"):
+                        stats[service][status] += 1
+    return stats
+
 def get_daily_stats_from_logs():
-    """从日志文件读取今天的统计数据"""
+    """从日志文件读取今天的统计数据（仅启动时用于恢复内存统计）"""
     today = datetime.now().strftime("%Y-%m-%d")
     log_file = os.path.join(LOGS_DIR, f"requests_{today}.jsonl")
     
-    stats = {
-        "date": today,
-        "image": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-        "video_t2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-        "video_i2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-    }
-    
-    if not os.path.exists(log_file):
-        return stats
+    stats = new_daily_stats(today)
     
     try:
-        with open(log_file, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip():
-                    try:
-                        entry = json.loads(line)
-                        service = entry.get("service")
-                        status = entry.get("status")
-                        
-                        if service in stats:
-                            stats[service]["total"] += 1
-                            if status in ["success", "failed", "rejected"]:
-                                stats[service][status] += 1
-                    except json.JSONDecodeError:
-                        continue
+        count_log_file(log_file, stats)
+    except FileNotFoundError:
+        pass
     except Exception as e:
         print(f"读取日志统计错误: {e}")
     
     return stats
 
+# 启动时从今天的日志恢复计数，重启后统计不归零
+daily_stats = get_daily_stats_from_logs()
+
+# 历史统计缓存：文件名 -> (mtime, 统计结果)，只有文件变化时才重新解析
+history_cache_lock = threading.Lock()
+history_cache = {}
+
+# 过去日期的统计汇总持久化到 logs/summary_{日期}.json，重启后不必重新解析整天的日志
+def load_stats_summary(date_str, mtime):
+    """读取汇总文件，日志在汇总之后有变化（mtime不一致）时返回None"""
+    try:
+        with open(os.path.join(LOGS_DIR, f"summary_{date_str}.json"), "rb") as f:
+            summary = orjson.loads(f.read())
+        if summary.get("mtime") == mtime:
+            return summary["stats"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"读取统计汇总错误 {date_str}: {e}")
+    return None
+
+def save_stats_summary(date_str, mtime, stats):
+    summary_path = os.path.join(LOGS_DIR, f"summary_{date_str}.json")
+    try:
+        with open(summary_path + ".part", "wb") as f:
+            f.write(orjson.dumps({"mtime": mtime, "stats": stats}))
+        os.replace(summary_path + ".part", summary_path)
+    except Exception as e:
+        print(f"保存统计汇总错误 {date_str}: {e}")
+
 def get_all_dates_stats():
     """获取所有日期的统计数据"""
     all_stats = []
@@ -422,33 +769,46 @@ def get_all_dates_stats():
         # 获取所有日志文件
         log_files = [f for f in os.listdir(LOGS_DIR) if f.startswith("requests_") and f.endswith(".jsonl")]
         log_files.sort(reverse=True)  # 最新的在前
+        log_files = log_files[:30]  # 最多显示最近30天
+        
+        with history_cache_lock:
+            # 清理已不在显示范围内的缓存
+            for cached_file in list(history_cache):
+                if cached_file not in log_files:
+                    del history_cache[cached_file]
         
-        for log_file in log_files[:30]:  # 最多显示最近30天
+        with stats_lock:
+            today_stats = copy.deepcopy(daily_stats)
+        
+        for log_file in log_files:
             date_str = log_file.replace("requests_", "").replace(".jsonl", "")
             
-            stats = {
-                "date": date_str,
-                "image": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-                "video_t2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-                "video_i2v": {"total": 0, "success": 0, "failed": 0, "rejected": 0},
-            }
+            # 今天的日志一直在追加，直接用内存统计，不必每次重新解析
+            if date_str == today_stats["date"]:
+                all_stats.append(today_stats)
+                continue
             
             log_path = os.path.join(LOGS_DIR, log_file)
-            with open(log_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    if line.strip():
-                        try:
-                            entry = json.loads(line)
-                            service = entry.get("service")
-                            status = entry.get("status")
-                            
-                            if service in stats:
-                                stats[service]["total"] += 1
-                                if status in ["success", "failed", "rejected"]:
-                                    stats[service][status] += 1
-                        except json.JSONDecodeError:
-                            continue
+            mtime = os.stat(log_path).st_mtime
+            
+            with history_cache_lock:
+                cached = history_cache.get(log_file)
+            if cached and cached[0] == mtime:
+                all_stats.append(cached[1])
+                continue
+            
+            stats = load_stats_summary(date_str, mtime)
+            if stats is not None:
+                with history_cache_lock:
+                    history_cache[log_file] = (mtime, stats)
+                all_stats.append(stats)
+                continue
             
+            stats = count_log_file(log_path, new_daily_stats(date_str))
+            
+            with history_cache_lock:
+                history_cache[log_file] = (mtime, stats)
+            save_stats_summary(date_str, mtime, stats)
             all_stats.append(stats)
     except Exception as e:
         print(f"读取历史统计错误: {e}")
@@ -456,36 +816,42 @@ def get_all_dates_stats():
     return all_stats
 
 # ===== ComfyUI 直接API调用 =====
-def submit_to_comfyui(workflow):
+def build_prompt_body(workflow_json, client_id):
+    """拼接 /prompt 请求体（workflow_json 为已编码的工作流）"""
+    # 注意：payload的key是"prompt"，不是"workflow"
+    return b'{"prompt":' + workflow_json + b',"client_id":' + orjson.dumps(client_id) + b'}'
+
+last_image_submit = time.monotonic()  # 最近一次提交图像任务的时间，预热线程据此判断是否空闲
+
+def submit_to_comfyui(workflow_json):
     """直接提交到ComfyUI - 参考test_comfyui_api.py的实现"""
+    global last_image_submit
+    last_image_submit = time.monotonic()
     try:
-        # 注意：payload的key是"prompt"，不是"workflow"
-        prompt_data = {
-            "prompt": workflow,  # ComfyUI API要求key为"prompt"
-            "client_id": COMFYUI_CLIENT_ID
-        }
         
-        url = f"{COMFYUI_API_URL}/prompt"
+        base_url, session = get_comfyui_endpoint()
+        url = f"{base_url}/prompt"
         
-        response = requests.post(
+        response = session.post(
             url,
-            json=prompt_data,
-            timeout=120
+            data=build_prompt_body(workflow_json, COMFYUI_CLIENT_ID),
+            headers={"Content-Type": "application/json"},
+            timeout=COMFYUI_SUBMIT_TIMEOUT
         )
         
         if response.status_code != 200:
             print(f"❌ ComfyUI error {response.status_code}: {response.text[:100]}")
         
         response.raise_for_status()
-        result = response.json()
+        result = orjson.loads(response.content)
         prompt_id = result.get("prompt_id")
         return prompt_id
     except requests.exceptions.ConnectionError as e:
-        print(f"❌ ComfyUI连接错误: 无法连接到 {COMFYUI_API_URL}")
+        print(f"❌ ComfyUI连接错误: 无法连接到 {base_url}")
         print(f"   请检查: 1) ComfyUI是否运行在该地址 2) 网络是否可达")
         return None
     except requests.exceptions.Timeout:
-        print(f"❌ ComfyUI超时: 连接超时（30秒）")
+        print(f"❌ ComfyUI超时: 请求超时（{COMFYUI_SUBMIT_TIMEOUT[1]}秒）")
         return None
     except requests.exceptions.HTTPError as e:
         print(f"❌ ComfyUI HTTP错误: {e}")
@@ -501,27 +867,123 @@ def submit_to_comfyui(workflow):
 def get_comfyui_history(prompt_id):
     """获取ComfyUI执行历史"""
     try:
-        response = requests.get(
-            f"{COMFYUI_API_URL}/history/{prompt_id}",
-            timeout=10
+        base_url, session = get_comfyui_endpoint()
+        response = session.get(
+            f"{base_url}/history/{prompt_id}",
+            timeout=(COMFYUI_CONNECT_TIMEOUT, 10)
         )
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except Exception as e:
         print(f"获取历史失败: {e}")
         return None
 
-def get_comfyui_image(filename, subfolder="", folder_type="output"):
-    """从ComfyUI获取生成的图片"""
+def cancel_comfyui_prompt(prompt_id, get_endpoint=get_comfyui_endpoint):
+    """客户端断开时把还在排队的任务从ComfyUI队列中删除（已开始执行的任务不受影响）"""
+    try:
+        base_url, session = get_endpoint()
+        session.post(
+            f"{base_url}/queue",
+            json={"delete": [prompt_id]},
+            timeout=(COMFYUI_CONNECT_TIMEOUT, 5),
+            verify=False
+        )
+        print(f"🛑 客户端已断开，取消排队任务: {prompt_id}")
+    except Exception as e:
+        print(f"取消任务失败: {e}")
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 下载时每次写入1MB
+
+# 结果下载放到后台线程执行，流式响应在等待期间照常发送心跳
+# 每个视频名额对应一个线程，视频任务同时完成时下载不用排队；图片没有并发限制，下载很快，另外预留一些线程
+DOWNLOAD_IMAGE_WORKERS = 8
+DOWNLOAD_WORKERS = MAX_CONCURRENT_T2V + MAX_CONCURRENT_I2V + DOWNLOAD_IMAGE_WORKERS
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+class DownloadCancelled(Exception):
+    """客户端已断开，后台下载中止"""
+
+def run_with_keepalive(keepalive_event, func, *args, **kwargs):
+    """在后台线程执行 func，等待期间每 SSE_KEEPALIVE_INTERVAL 秒产出一次心跳
+
+    在流式生成器中用 `result = yield from run_with_keepalive(...)` 调用。
+    func 需要接受 cancelled 参数（threading.Event）：客户端断开、生成器被关闭时置位，
+    还没开始的下载直接取消，正在进行的下载在下一个分块处中止并删除 .part 临时文件。
+    """
+    cancelled = threading.Event()
+    future = download_executor.submit(func, *args, cancelled=cancelled, **kwargs)
+    try:
+        while True:
+            try:
+                return future.result(timeout=SSE_KEEPALIVE_INTERVAL)
+            except FutureTimeoutError:
+                yield keepalive_event
+    except GeneratorExit:
+        future.cancel()
+        cancelled.set()
+        raise
+
+def save_response_to_file(response, out_path, cancelled=None):
+    """把流式响应分块写入磁盘，不在内存中缓存整个文件
+
+    先写入 .part 临时文件，完成后再原子替换，避免提供未写完的文件。
+    存储计数只在文件以最终文件名落盘后更新；覆盖已有文件（重试下载）时只计大小差值。
+    cancelled 被置位时抛出 DownloadCancelled，临时文件随之删除。
+    """
+    tmp_path = out_path + ".part"
+    size = 0
+    old_size = None
+    try:
+        # 直接对文件描述符写入：分块已经足够大，不再经过Python的文件缓冲层
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled(out_path)
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view):]
+                size += len(chunk)
+        finally:
+            os.close(fd)
+        if cancelled is not None and cancelled.is_set():
+            raise DownloadCancelled(out_path)
+        try:
+            old_size = os.stat(out_path).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, out_path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        response.close()
+    
+    if old_size is None:
+        track_storage(size)
+    else:
+        track_storage(size - old_size, 0)
+    return out_path
+
+def get_comfyui_image(filename, subfolder="", folder_type="output", out_path=None, cancelled=None):
+    """从ComfyUI下载生成的图片到 out_path，成功返回 out_path"""
     try:
         params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        response = requests.get(
-            f"{COMFYUI_API_URL}/view",
+        base_url, session = get_comfyui_endpoint()
+        response = session.get(
+            f"{base_url}/view",
             params=params,
-            timeout=120  # 2分钟超时
+            timeout=COMFYUI_DOWNLOAD_TIMEOUT,  # 读取最长2分钟
+            stream=True
         )
         response.raise_for_status()
-        return response.content
+        return save_response_to_file(response, out_path, cancelled)
+    except DownloadCancelled:
+        print(f"🛑 客户端已断开，图片下载中止: {out_path}")
+        return None
     except Exception as e:
         print(f"获取图片失败: {e}")
         return None
@@ -531,14 +993,15 @@ def get_comfyui_image(filename, subfolder="", folder_type="output"):
 def upload_image_to_comfyui(image_data_bytes, filename):
     """上传图片到ComfyUI服务器"""
     try:
-        url = f"{COMFYUI_VIDEO_API_URL}/upload/image"
+        base_url, session = get_comfyui_video_endpoint()
+        url = f"{base_url}/upload/image"
         
         # 构建multipart form data
         files = {
             'image': (filename, image_data_bytes, 'image/png')
         }
         
-        response = requests.post(url, files=files, timeout=60, verify=False)
+        response = session.post(url, files=files, timeout=COMFYUI_UPLOAD_TIMEOUT, verify=False)
         response.raise_for_status()
         
         result = response.json()
@@ -551,22 +1014,19 @@ def upload_image_to_comfyui(image_data_bytes, filename):
         print(f"上传图片到ComfyUI失败: {e}")
         raise
 
-def submit_video_to_comfyui(workflow):
+def submit_video_to_comfyui(workflow_json):
     """提交视频生成任务到ComfyUI（直连）"""
     try:
-        prompt_data = {
-            "prompt": workflow,
-            "client_id": COMFYUI_VIDEO_CLIENT_ID
-        }
-        
-        url = f"{COMFYUI_VIDEO_API_URL}/prompt"
+        base_url, session = get_comfyui_video_endpoint()
+        url = f"{base_url}/prompt"
         print(f"  → 连接到ComfyUI视频端点: {url}")
         print(f"  → Client ID: {COMFYUI_VIDEO_CLIENT_ID}")
         
-        response = requests.post(
+        response = session.post(
             url,
-            json=prompt_data,
-            timeout=120,
+            data=build_prompt_body(workflow_json, COMFYUI_VIDEO_CLIENT_ID),
+            headers={"Content-Type": "application/json"},
+            timeout=COMFYUI_SUBMIT_TIMEOUT,
             verify=False
         )
         print(f"  → HTTP状态: {response.status_code}")
@@ -575,7 +1035,7 @@ def submit_video_to_comfyui(workflow):
             print(f"  → 响应内容: {response.text[:200]}")
         
         response.raise_for_status()
-        result = response.json()
+        result = orjson.loads(response.content)
         
         prompt_id = result.get("prompt_id")
         if not prompt_id:
@@ -601,14 +1061,15 @@ def submit_video_to_comfyui(workflow):
 def check_comfyui_video_status(prompt_id):
     """检查ComfyUI视频生成状态"""
     try:
-        url = f"{COMFYUI_VIDEO_API_URL}/history/{prompt_id}"
-        response = requests.get(url, timeout=30, verify=False)
+        base_url, session = get_comfyui_video_endpoint()
+        url = f"{base_url}/history/{prompt_id}"
+        response = session.get(url, timeout=COMFYUI_POLL_TIMEOUT, verify=False)
         
         if response.status_code != 200:
             print(f"⚠️ ComfyUI history API 返回状态码: {response.status_code}")
             return None
         
-        history = response.json()
+        history = orjson.loads(response.content)
         
         if prompt_id not in history:
             return {"status": "IN_QUEUE"}
@@ -616,12 +1077,13 @@ def check_comfyui_video_status(prompt_id):
         task_info = history[prompt_id]
         
         # 调试：打印任务信息的关键字段
-        print(f"📋 任务 {prompt_id} 信息:")
-        print(f"  → 包含的键: {list(task_info.keys())}")
-        if "status" in task_info:
-            print(f"  → status: {task_info['status']}")
-        if "outputs" in task_info:
-            print(f"  → outputs keys: {list(task_info['outputs'].keys())}")
+        if DEBUG_COMFY:
+            print(f"📋 任务 {prompt_id} 信息:")
+            print(f"  → 包含的键: {list(task_info.keys())}")
+            if "status" in task_info:
+                print(f"  → status: {task_info['status']}")
+            if "outputs" in task_info:
+                print(f"  → outputs keys: {list(task_info['outputs'].keys())}")
         
         # 检查是否完成
         if "outputs" in task_info and task_info["outputs"]:
@@ -651,8 +1113,9 @@ def check_comfyui_video_status(prompt_id):
             print(f"❌ 任务失败")
             return {"status": "FAILED"}
         
-        # 否则仍在处理中
-        print(f"⏳ 任务处理中...")
+        # 否则仍在处理中（每次轮询都会走到这里，只在调试时打印）
+        if DEBUG_COMFY:
+            print(f"⏳ 任务处理中...")
         return {"status": "IN_PROGRESS"}
     
     except Exception as e:
@@ -661,23 +1124,25 @@ def check_comfyui_video_status(prompt_id):
         traceback.print_exc()
         return None
 
-def download_comfyui_video(outputs):
-    """从ComfyUI下载生成的视频 - 与图片提取方式一致"""
+def download_comfyui_video(outputs, out_path, cancelled=None):
+    """从ComfyUI下载生成的视频到 out_path - 与图片提取方式一致"""
     try:
         # 调试：打印完整的outputs结构
-        print(f"📦 ComfyUI返回的outputs结构:")
-        import json
-        print(json.dumps(outputs, indent=2, ensure_ascii=False))
+        if DEBUG_COMFY:
+            print(f"📦 ComfyUI返回的outputs结构:")
+            print(orjson.dumps(outputs, option=orjson.OPT_INDENT_2).decode())
         
         # 查找视频输出节点（SaveVideo可能使用 images、videos 或 gifs 字段）
         for node_id, node_output in outputs.items():
-            print(f"  → 节点 {node_id}: {list(node_output.keys())}")
+            if DEBUG_COMFY:
+                print(f"  → 节点 {node_id}: {list(node_output.keys())}")
             
             # 按优先级尝试多种可能的输出格式
             # 1. 尝试 videos 字段
             if "videos" in node_output:
                 videos = node_output["videos"]
-                print(f"  → 找到videos字段，内容: {videos}")
+                if DEBUG_COMFY:
+                    print(f"  → 找到videos字段，内容: {videos}")
                 if videos and len(videos) > 0:
                     video_info = videos[0]
                     filename = video_info.get("filename")
@@ -685,14 +1150,14 @@ def download_comfyui_video(outputs):
                     
                     if filename:
                         print(f"  → 提取视频文件: {filename}, 子目录: {subfolder}")
-                        video_data = get_comfyui_video(filename, subfolder)
-                        if video_data:
-                            return video_data
+                        if get_comfyui_video(filename, subfolder, out_path, cancelled):
+                            return out_path
             
             # 2. 尝试 images 字段（SaveVideo 节点可能使用这个）
             if "images" in node_output:
                 images = node_output["images"]
-                print(f"  → 找到images字段，内容: {images}")
+                if DEBUG_COMFY:
+                    print(f"  → 找到images字段，内容: {images}")
                 if images and len(images) > 0:
                     # 检查是否是视频文件（通过文件扩展名或 animated 标志）
                     image_info = images[0]
@@ -703,14 +1168,14 @@ def download_comfyui_video(outputs):
                     # 如果文件名是视频格式或标记为动画
                     if filename and (filename.endswith(('.mp4', '.webm', '.avi', '.mov', '.gif')) or is_animated):
                         print(f"  → 提取视频文件: {filename}, 子目录: {subfolder}, 动画: {is_animated}")
-                        video_data = get_comfyui_video(filename, subfolder)
-                        if video_data:
-                            return video_data
+                        if get_comfyui_video(filename, subfolder, out_path, cancelled):
+                            return out_path
             
             # 3. 尝试 gifs 字段（某些节点可能输出gif）
             if "gifs" in node_output:
                 gifs = node_output["gifs"]
-                print(f"  → 找到gifs字段，内容: {gifs}")
+                if DEBUG_COMFY:
+                    print(f"  → 找到gifs字段，内容: {gifs}")
                 if gifs and len(gifs) > 0:
                     gif_info = gifs[0]
                     filename = gif_info.get("filename")
@@ -718,21 +1183,23 @@ def download_comfyui_video(outputs):
                     
                     if filename:
                         print(f"  → 提取GIF文件: {filename}, 子目录: {subfolder}")
-                        video_data = get_comfyui_video(filename, subfolder)
-                        if video_data:
-                            return video_data
+                        if get_comfyui_video(filename, subfolder, out_path, cancelled):
+                            return out_path
         
         print("❌ 未找到视频输出（检查了videos、images、gifs字段）")
         return None
     
+    except DownloadCancelled:
+        print(f"🛑 客户端已断开，视频下载中止: {out_path}")
+        return None
     except Exception as e:
         print(f"下载ComfyUI视频时出错: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-def get_comfyui_video(filename, subfolder=""):
-    """从ComfyUI下载视频文件 - 与get_comfyui_image类似"""
+def get_comfyui_video(filename, subfolder="", out_path=None, cancelled=None):
+    """从ComfyUI下载视频文件到 out_path - 与get_comfyui_image类似"""
     try:
         params = {
             "filename": filename,
@@ -743,37 +1210,317 @@ def get_comfyui_video(filename, subfolder=""):
         
         from urllib.parse import urlencode
         query_string = urlencode(params)
-        url = f"{COMFYUI_VIDEO_API_URL}/view?{query_string}"
+        base_url, session = get_comfyui_video_endpoint()
+        url = f"{base_url}/view?{query_string}"
         
         print(f"  → 下载视频: {url}")
         
-        response = requests.get(url, timeout=120, verify=False)
+        response = session.get(url, timeout=COMFYUI_DOWNLOAD_TIMEOUT, verify=False, stream=True)
         response.raise_for_status()
         
-        return response.content
+        return save_response_to_file(response, out_path, cancelled)
     
+    except DownloadCancelled:
+        raise  # 由 download_comfyui_video 处理，不再尝试其他输出节点
     except Exception as e:
         print(f"下载视频失败: {e}")
         return None
 
+# ===== ComfyUI WebSocket 事件推送 =====
+class ComfyUIEventListener:
+    """订阅ComfyUI的 /ws?clientId=... 推送，任务执行结束时立即唤醒等待中的流式响应
+
+    每个client_id只维持一条长连接；未安装websocket-client或连接断开时，
+    wait() 只是按原间隔超时返回，调用方继续轮询history。
+    cancel() 可以随时唤醒等待中的流并让它结束。
+    progress() 返回采样节点最近一次推送的进度 (value, max)。
+    只有 track() 会登记任务，流结束时由 discard() 移除；其他任务的推送直接忽略，
+    所以登记数量不会超过正在进行的流，也不需要淘汰。
+    """
+
+    def __init__(self, name, get_base_url, client_id, verify_ssl=True):
+        self.name = name
+        self._get_base_url = get_base_url  # 每次连接时读取，跟随 update_endpoint 的修改
+        self._client_id = client_id
+        self._sslopt = None if verify_ssl else {"cert_reqs": ssl.CERT_NONE}
+        self._events = {}
+        self._cancelled = set()
+        self._progress = {}
+        self._lock = threading.Lock()
+        self._ws = None
+        self.connected = False
+
+    def start(self):
+        if websocket is None:
+            print(f"⚠️  websocket-client 未安装，{self.name}任务使用HTTP轮询")
+            return
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def reconnect(self):
+        """关闭当前连接，后台线程会使用最新的端点地址重新连接"""
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _ws_url(self):
+        base = self._get_base_url()
+        if base.startswith("https://"):
+            base = "wss://" + base[len("https://"):]
+        elif base.startswith("http://"):
+            base = "ws://" + base[len("http://"):]
+        return f"{base}/ws?clientId={self._client_id}"
+
+    def _run(self):
+        retry_delay = 5
+        while True:
+            url = self._ws_url()
+            try:
+                self._ws = websocket.create_connection(url, timeout=COMFYUI_CONNECT_TIMEOUT, sslopt=self._sslopt)
+                self._ws.settimeout(None)
+                self.connected = True
+                retry_delay = 5
+                print(f"🔌 {self.name}事件推送已连接: {url}")
+                while True:
+                    message = self._ws.recv()
+                    # 二进制帧是预览图，忽略
+                    if isinstance(message, str) and message:
+                        self._handle(orjson.loads(message))
+            except Exception as e:
+                if self.connected:
+                    print(f"⚠️  {self.name}事件推送断开，回退到HTTP轮询: {e}")
+            finally:
+                self.connected = False
+                ws, self._ws = self._ws, None
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+
+    def _handle(self, message):
+        message_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if message_type == "progress":
+            # 只记录正在等待的任务，避免无人读取的记录堆积
+            if prompt_id in self._events:
+                self._progress[prompt_id] = (data.get("value"), data.get("max"))
+        # 任务结束（成功或失败）时ComfyUI发送 node 为 null 的 executing 消息，此时history已写入
+        # 未登记的任务（其他客户端、已结束的流）不创建记录
+        elif message_type == "executing" and prompt_id and data.get("node") is None:
+            with self._lock:
+                event = self._events.get(prompt_id)
+            if event is not None:
+                event.set()
+
+    def wait(self, prompt_id, timeout):
+        """等待任务结束事件（或取消），返回True表示被提前唤醒；未登记的任务只按超时等待"""
+        with self._lock:
+            event = self._events.get(prompt_id)
+        if event is None:
+            time.sleep(max(timeout, 0))
+            return False
+        if event.wait(max(timeout, 0)):
+            event.clear()
+            return True
+        return False
+
+    def track(self, prompt_id):
+        """流开始时登记任务，之后才能收到结束推送、被 cancel()"""
+        with self._lock:
+            if prompt_id not in self._events:
+                self._events[prompt_id] = threading.Event()
+
+    def cancel(self, prompt_id):
+        """标记任务已取消并唤醒等待中的流，返回False表示没有正在等待这个任务的流"""
+        with self._lock:
+            event = self._events.get(prompt_id)
+            if event is None:
+                return False
+            self._cancelled.add(prompt_id)
+        event.set()
+        return True
+
+    def is_cancelled(self, prompt_id):
+        return prompt_id in self._cancelled
+
+    def progress(self, prompt_id):
+        return self._progress.get(prompt_id)
+
+    def discard(self, prompt_id):
+        with self._lock:
+            self._events.pop(prompt_id, None)
+            self._cancelled.discard(prompt_id)
+            self._progress.pop(prompt_id, None)
+
+comfyui_image_events = ComfyUIEventListener("图像", lambda: COMFYUI_API_URL, COMFYUI_CLIENT_ID)
+comfyui_image_events.start()
+
+comfyui_video_events = ComfyUIEventListener(
+    "视频", lambda: COMFYUI_VIDEO_API_URL, COMFYUI_VIDEO_CLIENT_ID, verify_ssl=False
+)
+comfyui_video_events.start()
+
+# ===== 内存回收 =====
+# 策略：按时间限流。视频流结束时只发通知，由后台线程执行回收，两次回收至少间隔 MEMORY_TRIM_MIN_INTERVAL 秒，
+# 限流期间到达的通知合并成一次。完整GC和 malloc_trim 都要遍历整个堆，放在请求线程里会拖住连接关闭；
+# 而视频任务结束正是大块临时内存刚被释放的时候，按时间限流既能及时归还内存，又把开销控制在每分钟最多一次。
+MEMORY_TRIM_MIN_INTERVAL = 60  # 两次回收至少间隔（秒）
+
+try:
+    malloc_trim = ctypes.CDLL("libc.so.6").malloc_trim
+except (OSError, AttributeError):
+    malloc_trim = None  # 非glibc系统（musl、macOS）只做GC
+
+memory_trim_requested = threading.Event()
+last_memory_trim = 0.0
+
+def request_memory_trim():
+    """视频流结束时调用：只做标记，立即返回"""
+    memory_trim_requested.set()
+
+def memory_trim_loop():
+    """等待视频流结束的通知并执行回收，距上次回收不足 MEMORY_TRIM_MIN_INTERVAL 秒时先等到间隔满"""
+    global last_memory_trim
+    while True:
+        memory_trim_requested.wait()
+        delay = last_memory_trim + MEMORY_TRIM_MIN_INTERVAL - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        memory_trim_requested.clear()
+        last_memory_trim = time.monotonic()
+        gc.collect()
+        if malloc_trim is not None:
+            malloc_trim(0)
+
+threading.Thread(target=memory_trim_loop, daemon=True).start()
+
+# ===== 视频并发自适应 =====
+def adapt_video_concurrency_loop():
+    """定期查询视频ComfyUI的 /queue：积压超过当前总并发时逐步收紧上限，队列清空时逐步放开
+
+    t2v/i2v 共用同一个视频后端，所以按两者的总上限比较积压。
+    """
+    while True:
+        time.sleep(VIDEO_ADAPT_INTERVAL)
+        try:
+            base_url, session = get_comfyui_video_endpoint()
+            response = session.get(f"{base_url}/queue", timeout=COMFYUI_POLL_TIMEOUT, verify=False)
+            response.raise_for_status()
+            pending = len(orjson.loads(response.content).get("queue_pending", []))
+        except Exception as e:
+            print(f"⚠️  查询视频队列失败: {e}")
+            continue
+        
+        total_limit = t2v_gate.max_concurrent + i2v_gate.max_concurrent
+        for gate, upper, name in ((t2v_gate, MAX_CONCURRENT_T2V, "文生视频"),
+                                  (i2v_gate, MAX_CONCURRENT_I2V, "图生视频")):
+            limit = gate.max_concurrent
+            if pending > total_limit:
+                new_limit = max(1, limit - 1)
+            elif pending == 0:
+                new_limit = min(upper, limit + 1)
+            else:
+                continue
+            if new_limit != limit:
+                gate.resize(new_limit)
+                print(f"📊 {name}并发上限调整: {limit} -> {new_limit}（ComfyUI排队 {pending}）")
+
+if ADAPTIVE_VIDEO_CONCURRENCY:
+    threading.Thread(target=adapt_video_concurrency_loop, daemon=True).start()
+
+# ===== 图像模型预热 =====
+def keep_warm_loop():
+    """图像端点空闲超过 KEEP_WARM_INTERVAL 时提交预热任务
+
+    只在本服务没有进行中的视频任务、且图像ComfyUI队列为空时提交，避免和正式任务抢显存。
+    每个空闲期只预热一次：预热成功后记录时间，直到有新的图像任务提交才会再次预热。
+    预热任务使用单独的client_id，不会推送到事件监听器。
+    """
+    last_warm_submit = 0.0
+    while True:
+        time.sleep(KEEP_WARM_INTERVAL)
+        if last_warm_submit > last_image_submit:
+            continue  # 上次正式任务之后已经预热过
+        if time.monotonic() - last_image_submit < KEEP_WARM_INTERVAL:
+            continue
+        if t2v_gate.snapshot() or i2v_gate.snapshot():
+            continue
+        try:
+            base_url, session = get_comfyui_endpoint()
+            response = session.get(f"{base_url}/queue", timeout=COMFYUI_POLL_TIMEOUT)
+            response.raise_for_status()
+            queue_info = orjson.loads(response.content)
+            if queue_info.get("queue_running") or queue_info.get("queue_pending"):
+                continue
+            session.post(
+                f"{base_url}/prompt",
+                data=build_prompt_body(WARM_IMAGE_WORKFLOW_JSON, "keep-warm"),
+                headers={"Content-Type": "application/json"},
+                timeout=COMFYUI_SUBMIT_TIMEOUT
+            ).raise_for_status()
+            last_warm_submit = time.monotonic()
+        except Exception as e:
+            print(f"⚠️  图像模型预热失败: {e}")
+
+if COMFYUI_KEEP_WARM:
+    threading.Thread(target=keep_warm_loop, daemon=True).start()
+
 # ===== API路由 =====
+def is_authorized(req):
+    """校验 Authorization 头中的API Key（常量时间比较，兼容不带 Bearer 前缀的写法）"""
+    auth_header = req.headers.get('Authorization', '')
+    if not auth_header:
+        return False
+    token = auth_header[7:] if auth_header.startswith("Bearer ") else auth_header
+    return hmac.compare_digest(token.encode(), SERVER_AUTH_KEY_BYTES)
+
+# 需要API Key的接口（按endpoint名），统一在 before_request 中校验
+AUTHED_ENDPOINTS = frozenset({
+    'update_endpoint', 'cancel_task', 'get_endpoints', 'get_storage_status',
+    'chat_completions', 'video_i2v_raw',
+})
+
+@app.before_request
+def require_auth():
+    """管理员接口和生成接口统一鉴权（OPTIONS预检请求不带Authorization，直接放行）"""
+    if request.endpoint not in AUTHED_ENDPOINTS or request.method == 'OPTIONS':
+        return None
+    if not is_authorized(request):
+        print(f"❌ Auth failed: {request.path}")
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
 @app.route('/files/images/<path:filename>')
 def serve_image(filename):
-    """提供图片文件访问"""
-    return send_from_directory(IMAGES_DIR, filename)
+    """提供图片文件访问（支持Range和304，启用USE_XACCEL时交给nginx发送）"""
+    if USE_XACCEL:
+        file_path = safe_join(IMAGES_DIR, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            return jsonify({"error": "Not found"}), 404
+        return Response(status=200, headers={
+            'X-Accel-Redirect': XACCEL_IMAGES_PREFIX + quote(filename),
+            'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        })
+    return send_from_directory(IMAGES_DIR, filename, conditional=True, max_age=FILES_MAX_AGE)
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    """获取统计信息 - 从日志文件读取真实数据"""
-    # 从日志文件读取今天的统计
-    today_stats = get_daily_stats_from_logs()
+    """获取统计信息 - 读取内存中的今日计数"""
+    with stats_lock:
+        roll_daily_stats(datetime.now().strftime("%Y-%m-%d"))
+        today_stats = copy.deepcopy(daily_stats)
     
     # 添加当前并发信息
-    with count_lock:
-        today_stats["current_video_t2v"] = MAX_CONCURRENT_T2V - t2v_semaphore._value
-        today_stats["current_video_i2v"] = MAX_CONCURRENT_I2V - i2v_semaphore._value
-        today_stats["max_concurrent_t2v"] = MAX_CONCURRENT_T2V
-        today_stats["max_concurrent_i2v"] = MAX_CONCURRENT_I2V
+    today_stats["current_video_t2v"] = t2v_gate.snapshot()
+    today_stats["current_video_i2v"] = i2v_gate.snapshot()
+    today_stats["max_concurrent_t2v"] = t2v_gate.max_concurrent
+    today_stats["max_concurrent_i2v"] = i2v_gate.max_concurrent
     
     return jsonify(today_stats)
 
@@ -789,11 +1536,6 @@ def get_stats_history():
 @app.route('/api/update_endpoint', methods=['POST'])
 def update_endpoint():
     """更新ComfyUI端点（管理员功能）"""
-    # 验证API Key
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header.replace("Bearer ", "") != SERVER_AUTH_KEY:
-        return jsonify({"error": "Unauthorized"}), 401
-    
     try:
         data = request.json
         endpoint_type = data.get('type')  # 'image' or 'video'
@@ -805,15 +1547,24 @@ def update_endpoint():
         if endpoint_type not in ['image', 'video']:
             return jsonify({"error": "Invalid type. Must be 'image' or 'video'"}), 400
         
-        # 更新全局变量
-        global COMFYUI_API_URL, COMFYUI_VIDEO_API_URL
+        # 更新全局变量：地址和会话一起替换，旧会话的连接池随之关闭（进行中的请求不受影响）
+        global COMFYUI_API_URL, COMFYUI_VIDEO_API_URL, comfyui_session, comfyui_video_session
+        
+        with endpoint_lock:
+            if endpoint_type == 'image':
+                COMFYUI_API_URL = new_url.rstrip('/')
+                old_session, comfyui_session = comfyui_session, create_comfyui_session()
+            else:
+                COMFYUI_VIDEO_API_URL = new_url.rstrip('/')
+                old_session, comfyui_video_session = comfyui_video_session, create_comfyui_session()
+        old_session.close()
         
         if endpoint_type == 'image':
-            COMFYUI_API_URL = new_url.rstrip('/')
             print(f"✅ 图像ComfyUI端点已更新为: {COMFYUI_API_URL}")
-        elif endpoint_type == 'video':
-            COMFYUI_VIDEO_API_URL = new_url.rstrip('/')
+            comfyui_image_events.reconnect()
+        else:
             print(f"✅ 视频ComfyUI端点已更新为: {COMFYUI_VIDEO_API_URL}")
+            comfyui_video_events.reconnect()
         
         return jsonify({
             "success": True,
@@ -825,14 +1576,23 @@ def update_endpoint():
         print(f"更新端点错误: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/cancel_task', methods=['POST'])
+def cancel_task():
+    """取消正在等待中的生成任务（管理员功能）"""
+    data = request.get_json(silent=True) or {}
+    prompt_id = data.get('prompt_id')
+    if not prompt_id:
+        return jsonify({"error": "Missing prompt_id"}), 400
+    
+    # 等待中的流被唤醒后自行结束，并把任务从ComfyUI队列中删除
+    if comfyui_image_events.cancel(prompt_id) or comfyui_video_events.cancel(prompt_id):
+        print(f"🛑 管理员取消任务: {prompt_id}")
+        return jsonify({"success": True, "prompt_id": prompt_id})
+    return jsonify({"error": "Task not found"}), 404
+
 @app.route('/api/get_endpoints', methods=['GET'])
 def get_endpoints():
     """获取当前ComfyUI端点（管理员功能）"""
-    # 验证API Key
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header.replace("Bearer ", "") != SERVER_AUTH_KEY:
-        return jsonify({"error": "Unauthorized"}), 401
-    
     return jsonify({
         "image_url": COMFYUI_API_URL,
         "video_url": COMFYUI_VIDEO_API_URL
@@ -841,19 +1601,11 @@ def get_endpoints():
 @app.route('/api/storage_status', methods=['GET'])
 def get_storage_status():
     """获取存储使用情况（管理员功能）"""
-    # 验证API Key
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header.replace("Bearer ", "") != SERVER_AUTH_KEY:
-        return jsonify({"error": "Unauthorized"}), 401
-    
     try:
-        # 计算当前存储使用
-        total_size = get_directory_size(IMAGES_DIR)
+        # 当前存储使用和文件数量（增量计数，无需扫描目录）
+        total_size, file_count = get_storage_usage()
         total_size_gb = total_size / (1024 ** 3)
         
-        # 统计文件数量
-        file_count = len([f for f in os.listdir(IMAGES_DIR) if os.path.isfile(os.path.join(IMAGES_DIR, f))])
-        
         # 计算使用百分比
         usage_percent = (total_size_gb / MAX_STORAGE_SIZE_GB) * 100
         
@@ -873,39 +1625,103 @@ def index():
     return send_from_directory('static', 'index.html')
 
 # ===== 支付 Webhook =====
+# Telegram通知队列：请求线程只负责入队，由后台线程复用同一个连接池发送
+TELEGRAM_QUEUE_SIZE = 10000  # 队列上限，Telegram长时间不可用时丢弃新通知而不是无限堆积
+TELEGRAM_WORKERS = 4
+telegram_queue = queue.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+telegram_session = requests.Session()
+telegram_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+TELEGRAM_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def telegram_sender_loop():
+    """后台Telegram发送线程"""
+    while True:
+        chat_id, encoded_text = telegram_queue.get()
+        try:
+            # 消息文本入队前已编码，这里只拼接chat_id
+            body = (b'{"chat_id":' + str(chat_id).encode()
+                    + b',"text":' + encoded_text + b',"parse_mode":"Markdown"}')
+            telegram_session.post(TELEGRAM_SEND_URL, data=body,
+                                  headers=TELEGRAM_JSON_HEADERS, timeout=5)
+        except Exception as e:
+            print(f"Failed to send TG notification to {chat_id}: {e}")
+
+for _ in range(TELEGRAM_WORKERS):
+    threading.Thread(target=telegram_sender_loop, daemon=True).start()
+
+def enqueue_telegram_message(chat_id, encoded_text):
+    """encoded_text 是 orjson.dumps(文本)，同一条消息发给多人时只编码一次"""
+    try:
+        telegram_queue.put_nowait((chat_id, encoded_text))
+    except queue.Full:
+        print(f"⚠️  Telegram通知队列已满，丢弃发送给 {chat_id} 的通知")
+
 def send_telegram_notification(user_id: int, message: str):
-    """发送Telegram通知给用户"""
+    """发送Telegram通知给用户（异步，不阻塞调用方）"""
     if not TELEGRAM_BOT_TOKEN:
         return
     
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        requests.post(url, json={
-            "chat_id": user_id,
-            "text": message,
-            "parse_mode": "Markdown"
-        }, timeout=5)
-    except Exception as e:
-        print(f"Failed to send TG notification: {e}")
+    enqueue_telegram_message(user_id, orjson.dumps(message))
 
 
 def notify_admin(message: str):
-    """发送通知给所有管理员"""
+    """发送通知给所有管理员（异步，不阻塞调用方）"""
     if not TELEGRAM_BOT_TOKEN or not ADMIN_IDS:
         return
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    
+    encoded_text = orjson.dumps(message)
     for admin_id in ADMIN_IDS:
-        try:
-            requests.post(url, json={
-                "chat_id": admin_id,
-                "text": message,
-                "parse_mode": "Markdown"
-            }, timeout=5)
-        except Exception as e:
-            print(f"Failed to send admin notification to {admin_id}: {e}")
+        enqueue_telegram_message(admin_id, encoded_text)
+
+
+# 套餐配置（与 bot.py 中的 PACKAGES 保持一致）
+PACKAGES = {
+    'test': {'credits': 10, 'price': 1.00, 'name': '🧪 Test Pack'},
+    'mini': {'credits': 60, 'price': 4.99, 'name': '🎓 Student Pack'},
+    'pro': {'credits': 130, 'price': 9.99, 'name': '🔥 Pro Pack'},
+    'ultra': {'credits': 450, 'price': 29.99, 'name': '👑 Whale Pack'}
+}
+
+# 支付失败类状态 -> 通知用户时的描述
+PAYMENT_STATUS_MESSAGES = {
+    'error': 'encountered an error',
+    'cancelled': 'was cancelled',
+    'expired': 'expired',
+    'cancelled duplicate': 'was cancelled (duplicate)'
+}
+
+# 最近已处理的支付引用：Plisio会重复回调，命中时直接返回，不再查询数据库
+# 只是进程内的快速路径，未命中时仍以数据库为准
+PROCESSED_PAYMENTS_TTL = 86400
+PROCESSED_PAYMENTS_MAX = 100000
+processed_payments = OrderedDict()  # external_ref -> 记录时间（按时间先后排列）
+processed_payments_lock = threading.Lock()
+
+# Plisio回调只有十几个字段，超过这个大小的请求体直接拒绝，不解析（由 LimitedRequest 在读取时检查）
+WEBHOOK_MAX_BODY = 8192
+
+def is_recently_processed(ref):
+    if not ref:
+        return False
+    with processed_payments_lock:
+        seen_at = processed_payments.get(ref)
+        return seen_at is not None and time.monotonic() - seen_at < PROCESSED_PAYMENTS_TTL
 
+def mark_processed(*refs):
+    now = time.monotonic()
+    with processed_payments_lock:
+        for ref in refs:
+            if ref:
+                processed_payments[ref] = now
+                processed_payments.move_to_end(ref)
+        # 淘汰过期和超出容量的记录（最旧的在前面）
+        while processed_payments:
+            oldest_ref, seen_at = next(iter(processed_payments.items()))
+            if len(processed_payments) <= PROCESSED_PAYMENTS_MAX and now - seen_at < PROCESSED_PAYMENTS_TTL:
+                break
+            del processed_payments[oldest_ref]
 
 @app.route('/webhooks/plisio', methods=['POST', 'GET'])
 def webhook_plisio():
@@ -941,8 +1757,7 @@ def webhook_plisio():
         # 检查是否超额支付
         expected_amount = float(invoice_sum) if invoice_sum else 0
         actual_amount = float(amount) if amount else 0
-        is_overpaid = actual_amount > expected_amount if expected_amount > 0 else False
-        overpaid_percentage = ((actual_amount / expected_amount) * 100) if expected_amount > 0 else 100
+        is_overpaid = expected_amount > 0 and actual_amount > expected_amount
         
         # 优先使用 txn_id，如果没有则使用 order_number
         external_ref = txn_id or order_number
@@ -956,26 +1771,19 @@ def webhook_plisio():
             print(f"⚠️  Missing order_number, cannot extract user info")
             return jsonify({"error": "Missing order_number"}), 400
             
+        _, _, rest = str(order_number).partition('_')
+        user_id_str, _, rest = rest.partition('_')
+        package_key, _, _ = rest.partition('_')
+        package_key = package_key or 'pro'  # 默认 pro 套餐
         try:
-            parts = order_number.split('_')
-            user_id = int(parts[1]) if len(parts) > 1 else None
-            package_key = parts[2] if len(parts) > 2 else 'pro'  # 默认 pro 套餐
-        except:
+            user_id = int(user_id_str)
+        except ValueError:
             user_id = None
-            package_key = 'pro'
         
         if not user_id:
             print(f"❌ Invalid order format: {order_number}")
             return jsonify({"error": "Invalid order_number format"}), 400
         
-        # 套餐配置（与 bot.py 中的 PACKAGES 保持一致）
-        PACKAGES = {
-            'test': {'credits': 10, 'price': 1.00, 'name': '🧪 Test Pack'},
-            'mini': {'credits': 60, 'price': 4.99, 'name': '🎓 Student Pack'},
-            'pro': {'credits': 130, 'price': 9.99, 'name': '🔥 Pro Pack'},
-            'ultra': {'credits': 450, 'price': 29.99, 'name': '👑 Whale Pack'}
-        }
-        
         # 获取套餐信息
         package = PACKAGES.get(package_key, PACKAGES['pro'])
         credits = package['credits']
@@ -988,34 +1796,41 @@ def webhook_plisio():
         elif status == 'completed':
             # 支付成功
             
-            # 检查是否已处理
-            if (txn_id and bot_db.check_payment_exists(txn_id)) or \
-               (order_number and bot_db.check_payment_exists(order_number)):
+            # 先查内存中最近处理过的，命中则不访问数据库
+            if is_recently_processed(txn_id) or is_recently_processed(order_number):
                 return jsonify({"status": "already_processed"}), 200
             
             # 使用实际支付的 USD 金额（如果有的话）
             usd_amount = float(source_amount) if source_amount else package['price']
             
-            # 添加积分
-            success = bot_db.add_credits(
+            # 添加积分（去重检查和入账在同一个事务里完成）
+            success = bot_db.add_credits_if_new(
                 user_id=user_id,
                 amount=credits,
                 money_amount=usd_amount,
                 currency=currency,
                 provider='plisio',
                 external_ref=external_ref,  # 使用 txn_id 或 order_number
+                alias_ref=order_number if txn_id else None,  # 没有 txn_id 时 external_ref 就是订单号
                 description=f"Plisio crypto payment: {package['name']}"
             )
             
+            if success is False:
+                mark_processed(txn_id, order_number)
+                return jsonify({"status": "already_processed"}), 200
+            
             if success:
-                # 简洁日志
-                overpaid_log = f" (overpaid {overpaid_percentage:.0f}%)" if is_overpaid else ""
+                mark_processed(txn_id, order_number)
+                
+                # 简洁日志（超额比例只在超额时计算，格式化一次供三条消息共用）
+                overpaid_pct = f"{actual_amount / expected_amount * 100:.0f}%" if is_overpaid else ""
+                overpaid_log = f" (overpaid {overpaid_pct})" if is_overpaid else ""
                 print(f"✅ Payment: User {user_id}, +{credits} credits, ${usd_amount}{overpaid_log}")
                 
                 # 构建消息（包含 overpaid 提示）
                 overpaid_msg = ""
                 if is_overpaid:
-                    overpaid_msg = f"\n💡 You paid {overpaid_percentage:.0f}% ({actual_amount:.8f} {crypto_currency}) - thank you for the tip! 💝"
+                    overpaid_msg = f"\n💡 You paid {overpaid_pct} ({actual_amount:.8f} {crypto_currency}) - thank you for the tip! 💝"
                 
                 # 发送 Telegram 通知给用户
                 send_telegram_notification(
@@ -1029,7 +1844,7 @@ def webhook_plisio():
                 )
                 
                 # 🔔 通知管理员（实时入账通知）
-                overpaid_admin_msg = f"\n💰 Overpaid: {overpaid_percentage:.0f}%" if is_overpaid else ""
+                overpaid_admin_msg = f"\n💰 Overpaid: {overpaid_pct}" if is_overpaid else ""
                 notify_admin(
                     f"💰 **NEW SALE!** 💰\n\n"
                     f"👤 User: `{user_id}`\n"
@@ -1047,16 +1862,10 @@ def webhook_plisio():
                 print(f"❌ Failed to add credits")
                 return jsonify({"error": "Failed to add credits"}), 500
             
-        elif status in ['error', 'cancelled', 'expired', 'cancelled duplicate']:
+        elif status in PAYMENT_STATUS_MESSAGES:
             
             # 通知用户
-            status_messages = {
-                'error': 'encountered an error',
-                'cancelled': 'was cancelled',
-                'expired': 'expired',
-                'cancelled duplicate': 'was cancelled (duplicate)'
-            }
-            status_msg = status_messages.get(status, status)
+            status_msg = PAYMENT_STATUS_MESSAGES.get(status, status)
             
             send_telegram_notification(
                 user_id,
@@ -1072,24 +1881,23 @@ def webhook_plisio():
         # 其他状态
         return jsonify({"status": "ok"}), 200
         
+    except RequestEntityTooLarge:
+        # 请求体超过 WEBHOOK_MAX_BODY（见 LimitedRequest）
+        return jsonify({"error": "Payload too large"}), 413
+    except (BadRequest, ValueError, TypeError, AttributeError) as e:
+        # 回调数据格式错误（请求体无法解析、金额无法解析、payload不是对象等），属于客户端问题
+        print(f"❌ Invalid webhook payload: {type(e).__name__}: {e}")
+        return jsonify({"error": "Invalid payload"}), 400
     except Exception as e:
-        print(f"❌ Webhook error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        # 详细错误只写日志，不返回给调用方
+        print(f"❌ Webhook error: {type(e).__name__}: {e}")
+        return jsonify({"error": "Internal error"}), 500
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """统一的OpenAI兼容接口"""
     # 记录请求日志
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    
-    # 验证API Key
-    auth_header = request.headers.get('Authorization')
-    
-    if not auth_header or auth_header.replace("Bearer ", "") != SERVER_AUTH_KEY:
-        print(f"❌ Auth failed")
-        return jsonify({"error": "Unauthorized"}), 401
 
     try:
         data = request.json
@@ -1123,10 +1931,11 @@ def chat_completions():
             elif item.get('type') == 'image_url':
                 url = item.get('image_url', {}).get('url', '')
                 if url.startswith('data:image'):
-                    try:
-                        input_image_base64 = url.split(',')[1]
-                    except:
-                        pass
+                    # 切掉 data:...;base64, 前缀，字符串直接交给 b64decode
+                    # 含非ASCII字符时 b64decode 抛出 ValueError，下面按解码失败返回400
+                    comma = url.find(',')
+                    if comma >= 0:
+                        input_image_base64 = url[comma + 1:]
     
     prompt_text = prompt_text.strip()
     
@@ -1138,37 +1947,111 @@ def chat_completions():
         print(f"🎬 识别为视频服务 - {'图生视频' if is_i2v else '文生视频'}")
         
         if is_i2v:
-            return handle_video_i2v(prompt_text, input_image_base64, model, stream, data)
+            image_data = None
+            if input_image_base64:
+                try:
+                    image_data = b64decode(input_image_base64)
+                except ValueError:
+                    return jsonify({"error": "图片base64解码失败"}), 400
+            return handle_video_i2v(prompt_text, image_data, model, stream, data)
         else:
             return handle_video_t2v(prompt_text, model, stream, data)
     else:
         # 图像服务
         return handle_image_generation(prompt_text, model, stream, data)
 
+@app.route('/v1/video/i2v', methods=['POST'])
+def video_i2v_raw():
+    """图生视频 - 请求体直接是图片二进制（Content-Type: image/png 等），省去JSON解析和base64解码
+
+    提示词和模型通过查询参数传入：/v1/video/i2v?prompt=...&model=...
+    也支持 multipart/form-data 上传：图片放在 image 字段，prompt/model 可放在表单字段或查询参数
+    返回与 /v1/chat/completions 相同的SSE流
+    """
+    if request.mimetype == 'multipart/form-data':
+        image_file = request.files.get('image')
+        if image_file is None:
+            return jsonify({"error": "multipart请求缺少 image 文件字段"}), 400
+        image_data = image_file.read()
+        params = request.form
+    elif request.mimetype.startswith('image/'):
+        image_data = request.get_data(cache=False)
+        params = request.args
+    else:
+        return jsonify({"error": "Content-Type必须是图片类型（例如 image/png）或 multipart/form-data"}), 415
+    
+    prompt_text = (params.get('prompt') or request.args.get('prompt', '')).strip()
+    model = params.get('model') or request.args.get('model', 'wan-video-i2v')
+    
+    return handle_video_i2v(prompt_text, image_data, model, True, {})
+
+# ===== SSE 流式响应 =====
+SSE_DONE = b"data: [DONE]\n\n"
+
+# 固定的提示文本预先编码成JSON字符串（bytes），发送时直接拼进事件，不再逐次编码
+MSG_EMPTY = orjson.dumps('')
+MSG_IMAGE_START = orjson.dumps('> 🎨 正在生成图片...\n\n')
+MSG_IMAGE_TIMEOUT = orjson.dumps('\n\n⏱️ 生成超时，请重试。')
+MSG_VIDEO_START = orjson.dumps('> 🚀 任务已提交，正在排队中...\n\n')
+MSG_VIDEO_FAILED = orjson.dumps('\n\n❌ 视频生成失败，请检查输入内容后重试。')
+MSG_VIDEO_TIMEOUT = orjson.dumps('\n\n⏱️ 任务超时（10分钟），请重试。')
+MSG_VIDEO_MISSING = orjson.dumps('⚠️ 生成完成但无法获取视频')
+MSG_CANCELLED = orjson.dumps('\n\n🛑 任务已取消。')
+
+def make_chunk_encoder(response_id, created_ts, model):
+    """返回 encode(content, finish=False, role=False)，直接拼出 chat.completion.chunk 的SSE事件（bytes）
+
+    id/created/model 在整个流中不变，前缀只序列化一次，每个事件只需编码content。
+    content 为 bytes 时视为已编码的JSON字符串（见 MSG_* 常量），原样拼入。
+    finish=True 的事件末尾已带上 [DONE]，调用方发送后直接结束即可。
+    """
+    # 角色字段只出现在首个事件里，所以并入"content"键前面的部分
+    head = (b'data: {"id":' + orjson.dumps(response_id)
+            + b',"object":"chat.completion.chunk","created":' + str(int(created_ts)).encode()
+            + b',"model":' + orjson.dumps(model)
+            + b',"choices":[{"index":0,"delta":{')
+    heads = {False: head + b'"content":', True: head + b'"role":"assistant","content":'}
+    # 结束事件和 [DONE] 合成一次写出，客户端在同一个包里收到结果和结束标记
+    tails = {False: b'},"finish_reason":null}]}\n\n', True: b'},"finish_reason":"stop"}]}\n\n' + SSE_DONE}
+    dumps = orjson.dumps  # 闭包变量，省去每次的全局+属性查找
+    
+    def encode(content, finish=False, role=False):
+        # 一次 %b 格式化生成整个事件，不产生中间拼接结果
+        if not isinstance(content, bytes):
+            content = dumps(content)
+        return b"%b%b%b" % (heads[role], content, tails[finish])
+    
+    return encode
+
+# 模型名中包含的尺寸关键字 -> (宽, 高)，按顺序匹配第一个
+IMAGE_SIZES = {
+    "square": (1024, 1024),
+    "portrait": (832, 1216),
+    "landscape": (1216, 832),
+}
+
 def handle_image_generation(prompt_text, model, stream, data):
     """处理图像生成 - 流式响应"""
     try:
-        # 解析尺寸
-        if "square" in model.lower():
-            width, height = 1024, 1024
-        elif "portrait" in model.lower():
-            width, height = 832, 1216
-        elif "landscape" in model.lower():
-            width, height = 1216, 832
-        else:
-            width = data.get('width', 1024)
-            height = data.get('height', 1024)
+        # 解析尺寸：模型名中没有尺寸关键字时使用请求中的 width/height
+        model_lower = model.lower()
+        width, height = next(
+            (size for keyword, size in IMAGE_SIZES.items() if keyword in model_lower),
+            (data.get('width', 1024), data.get('height', 1024))
+        )
         
         
         # 创建工作流
-        workflow = json.loads(json.dumps(IMAGE_WORKFLOW))
-        workflow["3"]["inputs"]["seed"] = random.randint(1, 999999999999999)
-        workflow["6"]["inputs"]["text"] = prompt_text
-        workflow["13"]["inputs"]["width"] = width
-        workflow["13"]["inputs"]["height"] = height
+        workflow_json = render_workflow(
+            IMAGE_WORKFLOW_TEMPLATE,
+            SEED=random.randint(1, 999999999999999),
+            PROMPT=prompt_text,
+            WIDTH=width,
+            HEIGHT=height,
+        )
         
         # 提交到ComfyUI
-        prompt_id = submit_to_comfyui(workflow)
+        prompt_id = submit_to_comfyui(workflow_json)
         if not prompt_id:
             error_msg = f"ComfyUI连接失败。请检查: 1) ComfyUI是否运行 2) 地址配置: {COMFYUI_API_URL}"
             print(f"❌ {error_msg}")
@@ -1179,101 +2062,94 @@ def handle_image_generation(prompt_text, model, stream, data):
         
         # 使用流式响应
         def generate_image_stream():
-            response_id = f"chatcmpl-{prompt_id}"
-            created_ts = int(time.time())
+            encode = make_chunk_encoder(f"chatcmpl-{prompt_id}", time.time(), model)
+            host = request.host_url.rstrip('/')
             
-            # 发送初始消息
-            initial_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': '> 🎨 正在生成图片...\n\n'}, 'finish_reason': None}]
-            }
-            yield f"data: {json.dumps(initial_chunk, ensure_ascii=False)}\n\n"
+            # 心跳消息在整个流中不变，只序列化一次
+            keepalive_event = encode(MSG_EMPTY)
             
-            # 轮询等待完成
-            start_time = time.time()
-            timeout = 300  # 5分钟超时
-            last_message = ""
+            # 等待完成：收到WebSocket结束推送后立即查询history，推送不可用时按退避间隔（1~5秒）轮询
+            # 时长统一用单调时钟，不受系统时间调整影响
+            start_time = time.monotonic()
+            deadline = start_time + 300  # 5分钟超时
+            next_keepalive = start_time + SSE_KEEPALIVE_INTERVAL
+            last_poll = float('-inf')
+            finished = True  # 首次进入先查询一次
+            poll_delay = POLL_DELAY_START
+            comfyui_image_events.track(prompt_id)
             
-            while time.time() - start_time < timeout:
-                history = get_comfyui_history(prompt_id)
-                if history and prompt_id in history:
-                    prompt_history = history[prompt_id]
-                    if "outputs" in prompt_history:
-                        # 任务完成
-                        outputs = prompt_history["outputs"]
-                        output_url = None
-                        
-                        # 提取图片
-                        for node_id, node_output in outputs.items():
-                            if "images" in node_output:
-                                images = node_output["images"]
-                                if images:
-                                    img = images[0]
-                                    filename = img["filename"]
-                                    subfolder = img.get("subfolder", "")
-                                    
-                                    # 下载图片
-                                    image_data = get_comfyui_image(filename, subfolder)
-                                    if image_data:
-                                        # 保存到本地
+            try:
+                # 发送初始消息
+                yield encode(MSG_IMAGE_START, role=True)
+                
+                while True:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    if comfyui_image_events.is_cancelled(prompt_id):
+                        cancel_comfyui_prompt(prompt_id)
+                        log_request("image", "failed", {"error": "Cancelled"})
+                        yield encode(MSG_CANCELLED, finish=True)
+                        return
+                    should_poll = (finished or not comfyui_image_events.connected
+                                   or now - last_poll >= COMFYUI_WS_FALLBACK_POLL)
+                    history = None
+                    if should_poll:
+                        last_poll = now
+                        history = get_comfyui_history(prompt_id)
+                    if history and prompt_id in history:
+                        prompt_history = history[prompt_id]
+                        if "outputs" in prompt_history:
+                            # 任务完成
+                            outputs = prompt_history["outputs"]
+                            output_url = None
+                            
+                            # 提取图片
+                            for node_id, node_output in outputs.items():
+                                if "images" in node_output:
+                                    images = node_output["images"]
+                                    if images:
+                                        img = images[0]
+                                        filename = img["filename"]
+                                        subfolder = img.get("subfolder", "")
+                                        
+                                        # 下载图片，直接写入本地文件（后台线程下载，期间照常发送心跳）
                                         out_filename = f"{prompt_id}.png"
                                         out_path = os.path.join(IMAGES_DIR, out_filename)
-                                        with open(out_path, "wb") as f:
-                                            f.write(image_data)
-                                        
-                                        host = request.host_url.rstrip('/')
-                                        output_url = f"{host}/files/images/{out_filename}"
-                                        break
-                        
-                        if output_url:
-                            log_request("image", "success", {"prompt_id": prompt_id})
-                            
-                            # 格式和图/comfyui_api_service.py保持一致
-                            content = f"![image]({output_url})\n"
+                                        saved = yield from run_with_keepalive(
+                                            keepalive_event, get_comfyui_image, filename, subfolder, out_path=out_path)
+                                        if saved:
+                                            output_url = f"{host}/files/images/{out_filename}"
+                                            break
                             
-                            # 发送最终结果
-                            final_chunk = {
-                                'id': response_id,
-                                'object': 'chat.completion.chunk',
-                                'created': created_ts,
-                                'model': model,
-                                'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': 'stop'}]
-                            }
-                            yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
-                            yield "data: [DONE]\n\n"
-                            return
-                
-                # 发送心跳保持连接
-                elapsed = int(time.time() - start_time)
-                if elapsed > 0 and elapsed % 5 == 0:
-                    progress_msg = f"> 🎨 正在生成中 ({elapsed}秒)...\n"
-                    if progress_msg != last_message:
-                        progress_chunk = {
-                            'id': response_id,
-                            'object': 'chat.completion.chunk',
-                            'created': created_ts,
-                            'model': model,
-                            'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': None}]
-                        }
-                        yield f"data: {json.dumps(progress_chunk, ensure_ascii=False)}\n\n"
-                        last_message = progress_msg
+                            if output_url:
+                                log_request("image", "success", {"prompt_id": prompt_id})
+                                
+                                # 格式和图/comfyui_api_service.py保持一致
+                                content = f"![image]({output_url})\n"
+                                
+                                # 发送最终结果
+                                yield encode(content, finish=True)
+                                return
+                    
+                    # 发送心跳保持连接（history查询可能阻塞，重新读取时间）
+                    now = time.monotonic()
+                    if now >= next_keepalive:
+                        yield keepalive_event
+                        next_keepalive = now + SSE_KEEPALIVE_INTERVAL
+                    
+                    finished = comfyui_image_events.wait(prompt_id, min(poll_delay, deadline - now))
+                    poll_delay = next_poll_delay(poll_delay)
                 
-                time.sleep(2)
-            
-            # 超时
-            log_request("image", "failed", {"error": "Timeout"})
-            timeout_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'content': '\n\n⏱️ 生成超时，请重试。'}, 'finish_reason': 'stop'}]
-            }
-            yield f"data: {json.dumps(timeout_chunk, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
+                # 超时
+                log_request("image", "failed", {"error": "Timeout"})
+                yield encode(MSG_IMAGE_TIMEOUT, finish=True)
+            except GeneratorExit:
+                # 客户端断开：WSGI服务器关闭生成器，不再轮询并取消排队中的任务
+                cancel_comfyui_prompt(prompt_id)
+                raise
+            finally:
+                comfyui_image_events.discard(prompt_id)
         
         # 返回流式响应（CORS头由@app.after_request统一处理）
         response = Response(stream_with_context(generate_image_stream()), mimetype='text/event-stream')
@@ -1286,61 +2162,166 @@ def handle_image_generation(prompt_text, model, stream, data):
         log_request("image", "failed", {"error": str(e)})
         return jsonify({"error": f"生成失败: {str(e)}"}), 500
 
-def handle_video_t2v(prompt_text, model, stream, data):
-    """处理文生视频（竖屏）- 使用ComfyUI直连"""
-    global t2v_count
+# 视频任务状态变化时推送的进度消息
+VIDEO_STATUS_MESSAGES = {
+    "IN_QUEUE": "> ⏳ 正在排队等待 GPU 资源...\n",
+    "IN_PROGRESS": "> 🎬 正在生成视频 (预计 2-3 分钟)...\n",
+}
+VIDEO_PROGRESS_INTERVAL = 15  # 采样进度消息的最小间隔（秒），其余时间照常发送心跳
+
+def generate_video_stream(prompt_id, model, service_type):
+    """视频任务的SSE流（文生视频/图生视频共用）
+
+    收到WebSocket结束推送后立即查询history；推送不可用时按退避间隔（1~5秒）轮询。
+    心跳最多每 SSE_KEEPALIVE_INTERVAL 秒一次，不再每轮等待都发送；
+    WebSocket推送了采样进度时，用进度消息代替心跳（最多每 VIDEO_PROGRESS_INTERVAL 秒一条）。
+    """
+    encode = make_chunk_encoder(f"chatcmpl-{prompt_id}", time.time(), model)
+    host = request.host_url.rstrip('/')
     
-    print(f"🎬 处理文生视频请求")
+    # 心跳和状态消息在整个流中不变，只序列化一次
+    keepalive_event = encode(MSG_EMPTY)
+    status_events = {status: encode(msg) for status, msg in VIDEO_STATUS_MESSAGES.items()}
     
-    # 检查并发限制
-    with count_lock:
-        current = t2v_count
+    # 等待完成
+    deadline = time.monotonic() + VIDEO_TIMEOUT
+    last_status = "IN_QUEUE"
+    last_poll = float('-inf')
+    finished = True  # 首次进入先查询一次
+    poll_delay = POLL_DELAY_START
+    last_progress = None
+    next_progress_at = 0.0
+    next_keepalive = 0.0
+    comfyui_video_events.track(prompt_id)
+    
+    def heartbeat():
+        """返回本轮要发送的进度或心跳消息，还没到时间则返回None
+
+        时间在这里重新读取：调用前可能刚经历过阻塞的history查询或等待，外层的 now 已经过时
+        """
+        nonlocal last_progress, next_progress_at, next_keepalive
+        now = time.monotonic()
+        progress = comfyui_video_events.progress(prompt_id)
+        if progress is not None and progress != last_progress and now >= next_progress_at:
+            last_progress = progress
+            next_progress_at = now + VIDEO_PROGRESS_INTERVAL
+            next_keepalive = now + SSE_KEEPALIVE_INTERVAL
+            return encode(f"> 📈 采样进度 {progress[0]}/{progress[1]}\n")
+        if now < next_keepalive:
+            return None
+        next_keepalive = now + SSE_KEEPALIVE_INTERVAL
+        return keepalive_event
     
-    print(f"📊 当前并发: {current}/{MAX_CONCURRENT_T2V}")
+    try:
+        # 发送初始消息
+        yield encode(MSG_VIDEO_START, role=True)
+        
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if comfyui_video_events.is_cancelled(prompt_id):
+                cancel_comfyui_prompt(prompt_id, get_comfyui_video_endpoint)
+                log_request(service_type, "failed", {"error": "Cancelled"})
+                yield encode(MSG_CANCELLED, finish=True)
+                return
+            should_poll = (finished or not comfyui_video_events.connected
+                           or now - last_poll >= COMFYUI_WS_FALLBACK_POLL)
+            if not should_poll:
+                # 发送心跳（或进度）保持连接
+                event = heartbeat()
+                if event:
+                    yield event
+                finished = comfyui_video_events.wait(prompt_id, min(poll_delay, deadline - now))
+                poll_delay = next_poll_delay(poll_delay)
+                continue
+            
+            last_poll = now
+            status_data = check_comfyui_video_status(prompt_id)
+            now = time.monotonic()  # history查询可能阻塞到读取超时，之后的计时以查询结束为准
+            if not status_data:
+                finished = comfyui_video_events.wait(prompt_id, min(poll_delay, deadline - now))
+                poll_delay = next_poll_delay(poll_delay)
+                # 发送心跳
+                event = heartbeat()
+                if event:
+                    yield event
+                continue
+            
+            status = status_data.get("status")
+            
+            # 根据状态发送进度消息
+            if status != last_status and status in status_events:
+                yield status_events[status]
+                last_status = status
+                next_keepalive = now + SSE_KEEPALIVE_INTERVAL
+            else:
+                # 发送心跳保持连接
+                event = heartbeat()
+                if event:
+                    yield event
+            
+            if status == "COMPLETED":
+                outputs = status_data.get("outputs")
+                output_url = ""
+                
+                if outputs:
+                    # 下载视频 - 与图片提取方式一致，直接写入本地文件（后台线程下载，期间照常发送心跳）
+                    out_filename = f"{prompt_id}.mp4"
+                    out_path = os.path.join(IMAGES_DIR, out_filename)
+                    saved = yield from run_with_keepalive(keepalive_event, download_comfyui_video, outputs, out_path)
+                    if saved:
+                        output_url = f"{host}/files/images/{out_filename}"
+                
+                log_request(service_type, "success", {"prompt_id": prompt_id})
+                
+                content = f"✅ 视频生成成功！\n\n🎬 [点击这里]({output_url})\n\n访问链接: {output_url}" if output_url else MSG_VIDEO_MISSING
+                
+                # 发送最终结果
+                yield encode(content, finish=True)
+                return
+            
+            elif status == "FAILED":
+                log_request(service_type, "failed", {"status": status})
+                
+                yield encode(MSG_VIDEO_FAILED, finish=True)
+                return
+            
+            finished = comfyui_video_events.wait(prompt_id, min(poll_delay, deadline - now))
+            poll_delay = next_poll_delay(poll_delay)
+        
+        # 超时
+        log_request(service_type, "failed", {"error": "Timeout"})
+        yield encode(MSG_VIDEO_TIMEOUT, finish=True)
+    except GeneratorExit:
+        # 客户端断开：WSGI服务器关闭生成器，不再轮询并取消排队中的任务
+        cancel_comfyui_prompt(prompt_id, get_comfyui_video_endpoint)
+        raise
+    finally:
+        comfyui_video_events.discard(prompt_id)
+
+def handle_video_t2v(prompt_text, model, stream, data):
+    """处理文生视频（竖屏）- 使用ComfyUI直连"""
+    print(f"🎬 处理文生视频请求")
     
-    if not t2v_semaphore.acquire(blocking=False):
+    # 检查并发限制（当前并发见 /api/stats，这里不再加锁读取）
+    if not t2v_gate.acquire():
         print(f"❌ 并发已满，拒绝请求")
         log_request("video_t2v", "rejected", {"reason": "并发限制"})
-        return jsonify({"error": f"文生视频服务繁忙，当前并发已达上限({MAX_CONCURRENT_T2V})"}), 429
-    
-    with count_lock:
-        t2v_count += 1
+        return jsonify({"error": f"文生视频服务繁忙，当前并发已达上限({t2v_gate.max_concurrent})"}), 429, {"Retry-After": str(VIDEO_RETRY_AFTER)}
     
+    # 名额在流式响应结束时才释放；提前返回错误时由finally释放
+    release_slot = True
     try:
-        # 准备工作流
-        workflow = json.loads(json.dumps(T2V_WORKFLOW))
+        # 准备工作流（尺寸和负面提示词已写入模板）
         seed = random.randint(1, 999999999999999)
-        
-        # 🔇 简洁日志模式
-        # print(f"🎲 文生视频随机种子: {seed}")
-        
-        # 更新工作流参数 - 正面提示词
-        if "89" in workflow:
-            workflow["89"]["inputs"]["text"] = prompt_text
-        
-        # 更新负面提示词 - 与ComfyUI工作流一致（T2V包含额外的"裸露，NSFW"）
-        if "72" in workflow:
-            workflow["72"]["inputs"]["text"] = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走，裸露，NSFW"
-        
-        # 更新视频尺寸为竖屏
-        if "74" in workflow:
-            workflow["74"]["inputs"]["width"] = 480
-            workflow["74"]["inputs"]["height"] = 832
-            workflow["74"]["inputs"]["length"] = 81
-        
-        # 更新随机种子 - 需要同时更新两个KSampler节点
-        if "81" in workflow:
-            workflow["81"]["inputs"]["noise_seed"] = seed
-            # print(f"  → 节点81种子已更新: {seed}")
-        if "78" in workflow:
-            workflow["78"]["inputs"]["noise_seed"] = seed
-            # print(f"  → 节点78种子已更新: {seed}")
+        workflow_json = render_workflow(T2V_WORKFLOW_TEMPLATE, SEED=seed, PROMPT=prompt_text)
         
         print(f"📤 提交到ComfyUI视频端点")
         
         # 提交任务到ComfyUI
         try:
-            result = submit_video_to_comfyui(workflow)
+            result = submit_video_to_comfyui(workflow_json)
             prompt_id = result.get("prompt_id")
             
             if not prompt_id:
@@ -1354,213 +2335,49 @@ def handle_video_t2v(prompt_text, model, stream, data):
             log_request("video_t2v", "failed", {"error": str(submit_error)})
             return jsonify({"error": f"ComfyUI提交失败: {str(submit_error)}"}), 500
         
-        # 使用流式响应
-        def generate_video_stream():
-            response_id = f"chatcmpl-{prompt_id}"
-            created_ts = int(time.time())
-            
-            # 发送初始消息
-            initial_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': '> 🚀 任务已提交，正在排队中...\n\n'}, 'finish_reason': None}]
-            }
-            yield f"data: {json.dumps(initial_chunk, ensure_ascii=False)}\n\n"
-            
-            # 轮询等待完成
-            start_time = time.time()
-            last_status = "IN_QUEUE"
-            
-            while time.time() - start_time < VIDEO_TIMEOUT:
-                status_data = check_comfyui_video_status(prompt_id)
-                if not status_data:
-                    time.sleep(3)
-                    # 发送心跳
-                    keepalive_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(keepalive_chunk, ensure_ascii=False)}\n\n"
-                    continue
-                
-                status = status_data.get("status")
-                
-                # 根据状态发送进度消息
-                current_msg = ""
-                if status == "IN_QUEUE":
-                    current_msg = "> ⏳ 正在排队等待 GPU 资源...\n"
-                elif status == "IN_PROGRESS":
-                    current_msg = "> 🎬 正在生成视频 (预计 2-3 分钟)...\n"
-                
-                # 发送状态更新
-                if status != last_status and current_msg:
-                    status_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': current_msg}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(status_chunk, ensure_ascii=False)}\n\n"
-                    last_status = status
-                else:
-                    # 发送心跳保持连接
-                    keepalive_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(keepalive_chunk, ensure_ascii=False)}\n\n"
-                
-                if status == "COMPLETED":
-                    outputs = status_data.get("outputs")
-                    output_url = ""
-                    
-                    if outputs:
-                        # 下载视频 - 与图片提取方式一致
-                        video_data = download_comfyui_video(outputs)
-                        if video_data:
-                            out_filename = f"{prompt_id}.mp4"
-                            out_path = os.path.join(IMAGES_DIR, out_filename)
-                            with open(out_path, "wb") as f:
-                                f.write(video_data)
-                            
-                            host = request.host_url.rstrip('/')
-                            output_url = f"{host}/files/images/{out_filename}"
-                    
-                    log_request("video_t2v", "success", {"prompt_id": prompt_id})
-                    
-                    content = f"✅ 视频生成成功！\n\n🎬 [点击这里]({output_url})\n\n访问链接: {output_url}" if output_url else "⚠️ 生成完成但无法获取视频"
-                    
-                    # 发送最终结果
-                    final_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': 'stop'}]
-                    }
-                    yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                
-                elif status == "FAILED":
-                    log_request("video_t2v", "failed", {"status": status})
-                    
-                    fail_msg = '\n\n❌ 视频生成失败，请检查输入内容后重试。'
-                    fail_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': fail_msg}, 'finish_reason': 'stop'}]
-                    }
-                    yield f"data: {json.dumps(fail_chunk, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                
-                time.sleep(3)
-            
-            # 超时
-            log_request("video_t2v", "failed", {"error": "Timeout"})
-            timeout_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'content': '\n\n⏱️ 任务超时（10分钟），请重试。'}, 'finish_reason': 'stop'}]
-            }
-            yield f"data: {json.dumps(timeout_chunk, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
-        
         # 返回流式响应（CORS头由@app.after_request统一处理）
-        response = Response(stream_with_context(generate_video_stream()), mimetype='text/event-stream')
+        response = Response(stream_with_context(generate_video_stream(prompt_id, model, "video_t2v")), mimetype='text/event-stream')
         response.headers['Cache-Control'] = 'no-cache'
         response.headers['X-Accel-Buffering'] = 'no'
         response.headers['Connection'] = 'keep-alive'
+        response.call_on_close(t2v_gate.release)
+        response.call_on_close(request_memory_trim)
+        release_slot = False
         return response
         
     except Exception as e:
         log_request("video_t2v", "failed", {"error": str(e)})
         return jsonify({"error": f"生成失败: {str(e)}"}), 500
     finally:
-        with count_lock:
-            t2v_count -= 1
-        t2v_semaphore.release()
+        if release_slot:
+            t2v_gate.release()
 
-def handle_video_i2v(prompt_text, input_image_base64, model, stream, data):
-    """处理图生视频（竖屏）- 使用ComfyUI直连"""
-    global i2v_count
-    
-    if not input_image_base64:
+def handle_video_i2v(prompt_text, image_data, model, stream, data):
+    """处理图生视频（竖屏）- 使用ComfyUI直连，image_data为图片原始字节"""
+    if not image_data:
         return jsonify({"error": "图生视频需要提供图片"}), 400
     
     # 检查并发限制
-    with count_lock:
-        current = i2v_count
-    
-    if not i2v_semaphore.acquire(blocking=False):
+    if not i2v_gate.acquire():
         log_request("video_i2v", "rejected", {"reason": "并发限制"})
-        return jsonify({"error": f"图生视频服务繁忙，当前并发已达上限({MAX_CONCURRENT_I2V})"}), 429
-    
-    with count_lock:
-        i2v_count += 1
+        return jsonify({"error": f"图生视频服务繁忙，当前并发已达上限({i2v_gate.max_concurrent})"}), 429, {"Retry-After": str(VIDEO_RETRY_AFTER)}
     
+    # 名额在流式响应结束时才释放；提前返回错误时由finally释放
+    release_slot = True
     try:
-        # 准备工作流
-        workflow = json.loads(json.dumps(I2V_WORKFLOW))
+        # 准备工作流（尺寸和提示词已写入模板）
         seed = random.randint(1, 999999999999999)
         
-        # 🔇 简洁日志模式
-        # print(f"🎲 图生视频随机种子: {seed}")
-        
-        # 📝 图生视频使用工作流中固定的提示词，不再动态修改
-        # 正面提示词（节点93）和负面提示词（节点89）保持工作流JSON中的原始值
-        # print(f"  → 使用工作流固定提示词（不修改节点93和89）")
-        
-        # 更新视频尺寸为竖屏
-        if "98" in workflow:
-            workflow["98"]["inputs"]["width"] = 480
-            workflow["98"]["inputs"]["height"] = 832
-            workflow["98"]["inputs"]["length"] = 81
-        
-        # 🔥 关键修复：更新随机种子 - 需要同时更新两个KSampler节点
-        if "86" in workflow:
-            workflow["86"]["inputs"]["noise_seed"] = seed
-            # print(f"  → 节点86种子已更新: {seed}")
-        if "85" in workflow:
-            workflow["85"]["inputs"]["noise_seed"] = seed
-            # print(f"  → 节点85种子已更新: {seed}")
-        
-        # 保存输入图片到本地并上传到ComfyUI
+        # 直接上传到ComfyUI服务器（本地副本从未被读取，不再落盘）
         image_filename = f"i2v_input_{uuid.uuid4().hex}.png"
-        image_path = os.path.join(IMAGES_DIR, image_filename)
-        
-        # 解码base64图片
-        import base64
-        image_data = base64.b64decode(input_image_base64)
-        
-        # 保存到本地（用于后续清理）
-        with open(image_path, "wb") as f:
-            f.write(image_data)
-        
-        # 上传图片到ComfyUI服务器
         uploaded_filename = upload_image_to_comfyui(image_data, image_filename)
         
-        # 更新工作流中的图片引用
-        if "97" in workflow:
-            workflow["97"]["inputs"]["image"] = uploaded_filename
+        # 填入种子和图片引用
+        workflow_json = render_workflow(I2V_WORKFLOW_TEMPLATE, SEED=seed, IMAGE=uploaded_filename)
         
         # 提交任务到ComfyUI
         try:
-            result = submit_video_to_comfyui(workflow)
+            result = submit_video_to_comfyui(workflow_json)
             prompt_id = result.get("prompt_id")
         
             if not prompt_id:
@@ -1573,153 +2390,22 @@ def handle_video_i2v(prompt_text, input_image_base64, model, stream, data):
             log_request("video_i2v", "failed", {"error": str(submit_error)})
             return jsonify({"error": f"ComfyUI提交失败: {str(submit_error)}"}), 500
         
-        # 使用流式响应
-        def generate_i2v_stream():
-            response_id = f"chatcmpl-{prompt_id}"
-            created_ts = int(time.time())
-            
-            # 发送初始消息
-            initial_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': '> 🚀 任务已提交，正在排队中...\n\n'}, 'finish_reason': None}]
-            }
-            yield f"data: {json.dumps(initial_chunk, ensure_ascii=False)}\n\n"
-            
-            # 轮询等待完成
-            start_time = time.time()
-            last_status = "IN_QUEUE"
-            
-            while time.time() - start_time < VIDEO_TIMEOUT:
-                status_data = check_comfyui_video_status(prompt_id)
-                if not status_data:
-                    time.sleep(3)
-                    # 发送心跳
-                    keepalive_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(keepalive_chunk, ensure_ascii=False)}\n\n"
-                    continue
-                
-                status = status_data.get("status")
-                
-                # 根据状态发送进度消息
-                current_msg = ""
-                if status == "IN_QUEUE":
-                    current_msg = "> ⏳ 正在排队等待 GPU 资源...\n"
-                elif status == "IN_PROGRESS":
-                    current_msg = "> 🎬 正在生成视频 (预计 2-3 分钟)...\n"
-                
-                # 发送状态更新
-                if status != last_status and current_msg:
-                    status_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': current_msg}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(status_chunk, ensure_ascii=False)}\n\n"
-                    last_status = status
-                else:
-                    # 发送心跳保持连接
-                    keepalive_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': None}]
-                    }
-                    yield f"data: {json.dumps(keepalive_chunk, ensure_ascii=False)}\n\n"
-                
-                if status == "COMPLETED":
-                    outputs = status_data.get("outputs")
-                    output_url = ""
-                    
-                    if outputs:
-                        # 下载视频 - 与图片提取方式一致
-                        video_data = download_comfyui_video(outputs)
-                        if video_data:
-                            out_filename = f"{prompt_id}.mp4"
-                            out_path = os.path.join(IMAGES_DIR, out_filename)
-                            with open(out_path, "wb") as f:
-                                f.write(video_data)
-                            
-                            host = request.host_url.rstrip('/')
-                            output_url = f"{host}/files/images/{out_filename}"
-                    
-                    log_request("video_i2v", "success", {"prompt_id": prompt_id})
-                    
-                    content = f"✅ 视频生成成功！\n\n🎬 [点击这里]({output_url})\n\n访问链接: {output_url}" if output_url else "⚠️ 生成完成但无法获取视频"
-                    
-                    # 发送最终结果
-                    final_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': 'stop'}]
-                    }
-                    yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                
-                elif status == "FAILED":
-                    log_request("video_i2v", "failed", {"status": status})
-                    
-                    fail_msg = '\n\n❌ 视频生成失败，请检查输入内容后重试。'
-                    fail_chunk = {
-                        'id': response_id,
-                        'object': 'chat.completion.chunk',
-                        'created': created_ts,
-                        'model': model,
-                        'choices': [{'index': 0, 'delta': {'content': fail_msg}, 'finish_reason': 'stop'}]
-                    }
-                    yield f"data: {json.dumps(fail_chunk, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                
-                time.sleep(3)
-            
-            # 超时
-            log_request("video_i2v", "failed", {"error": "Timeout"})
-            timeout_chunk = {
-                'id': response_id,
-                'object': 'chat.completion.chunk',
-                'created': created_ts,
-                'model': model,
-                'choices': [{'index': 0, 'delta': {'content': '\n\n⏱️ 任务超时（10分钟），请重试。'}, 'finish_reason': 'stop'}]
-            }
-            yield f"data: {json.dumps(timeout_chunk, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
-        
         # 返回流式响应（CORS头由@app.after_request统一处理）
-        response = Response(stream_with_context(generate_i2v_stream()), mimetype='text/event-stream')
+        response = Response(stream_with_context(generate_video_stream(prompt_id, model, "video_i2v")), mimetype='text/event-stream')
         response.headers['Cache-Control'] = 'no-cache'
         response.headers['X-Accel-Buffering'] = 'no'
         response.headers['Connection'] = 'keep-alive'
+        response.call_on_close(i2v_gate.release)
+        response.call_on_close(request_memory_trim)
+        release_slot = False
         return response
         
     except Exception as e:
         log_request("video_i2v", "failed", {"error": str(e)})
         return jsonify({"error": f"生成失败: {str(e)}"}), 500
     finally:
-        # 清理临时图片文件
-        try:
-            if os.path.exists(image_path):
-                os.remove(image_path)
-        except:
-            pass
-        
-        with count_lock:
-            i2v_count -= 1
-        i2v_semaphore.release()
+        if release_slot:
+            i2v_gate.release()
 
 if __name__ == '__main__':
     import logging
@@ -1733,6 +2419,7 @@ if __name__ == '__main__':
     print("="*60)
     print(f"🌐 Port: 5010")
     print(f"📁 Files: {IMAGES_DIR}")
+    print("💡 开发服务器仅用于本地调试，生产环境: gunicorn -c gunicorn.conf.py server:app")
     print("="*60)
     
     app.run(host='0.0.0.0', port=5010, threaded=True)
@@ -321,6 +321,60 @@ class Database:
             logger.error(f"Failed to complete payment: {e}")
             return None
     
+    def add_credits_if_new(self, user_id: int, amount: int, description: str,
+                           money_amount: float = None, currency: str = None,
+                           provider: str = None, external_ref: str = None,
+                           alias_ref: str = None) -> Optional[bool]:
+        """
+        Idempotently record a completed payment and add credits in one transaction.
+        A pending record with the same external_ref is promoted to completed;
+        alias_ref (e.g. the order number) is also checked for an earlier completion.
+        When alias_ref is missing or equal to external_ref (callback without txn_id),
+        the alias lookup is skipped: a replay then hits the completed row through the
+        ON CONFLICT ... WHERE status = 'pending' guard, which updates nothing.
+        Returns: True if credits were added, False if already processed, None on error.
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                # 写锁覆盖检查和写入，并发回调只有一个能入账
+                cursor.execute("BEGIN IMMEDIATE")
+
+                # 别名与 external_ref 相同时无需单独查询，下面的唯一约束已经覆盖
+                if alias_ref and alias_ref != external_ref:
+                    cursor.execute(
+                        "SELECT 1 FROM transactions WHERE external_ref = ? AND status = 'completed'",
+                        (alias_ref,)
+                    )
+                    if cursor.fetchone():
+                        return False
+
+                # external_ref 有唯一约束：已完成的记录不会被覆盖，rowcount 为 0
+                cursor.execute("""
+                    INSERT INTO transactions (user_id, amount, money_amount, currency,
+                                            operation, description, provider, external_ref, status)
+                    VALUES (?, ?, ?, ?, 'ADD', ?, ?, ?, 'completed')
+                    ON CONFLICT (external_ref) DO UPDATE SET
+                        user_id = excluded.user_id,
+                        amount = excluded.amount,
+                        money_amount = excluded.money_amount,
+                        currency = excluded.currency,
+                        description = excluded.description,
+                        status = 'completed'
+                    WHERE transactions.status = 'pending'
+                """, (user_id, amount, money_amount, currency, description, provider, external_ref))
+                if cursor.rowcount == 0:
+                    return False
+
+                cursor.execute(
+                    "UPDATE users SET credits = credits + ? WHERE user_id = ?",
+                    (amount, user_id)
+                )
+                return True
+        except Exception as e:
+            logger.error(f"Failed to add credits: {e}")
+            return None
+
     def check_payment_exists(self, external_ref: str) -> bool:
         """Check if a payment with this external_ref already exists."""
         with self.get_connection() as conn: